@@ -3,9 +3,12 @@ import threading
 import time
 
 class ChatServer:
-    def __init__(self, host='localhost', port=12345):
+    NICK_TIMEOUT = 10  # Giây chờ client gửi nickname
+    
+    def __init__(self, host='localhost', port=12345, backlog=1024):
         self.host = host
         self.port = port
+        self.backlog = backlog  # Hàng đợi kết nối của kernel khi nhiều client vào cùng lúc
         self.clients = []  # Danh sách các client đang kết nối
         self.nicknames = []  # Danh sách tên của các client
         
@@ -33,6 +36,35 @@ class ChatServer:
             print(f"[SERVER] {nickname} đã ngắt kết nối")
             client.close()
     
+    def register_client(self, client, address):
+        """Hỏi nickname rồi thêm client vào chat room (chạy trên thread của client)"""
+        try:
+            # Yêu cầu client gửi nickname
+            client.settimeout(self.NICK_TIMEOUT)
+            client.send("NICK".encode('utf-8'))
+            nickname = client.recv(1024).decode('utf-8')
+            client.settimeout(None)
+        except Exception as e:
+            print(f"[SERVER] {address} không gửi nickname: {e}")
+            client.close()
+            return
+        
+        # Thêm client vào danh sách
+        self.clients.append(client)
+        self.nicknames.append(nickname)
+        
+        print(f"[SERVER] {nickname} đã tham gia chat room")
+        
+        # Thông báo cho tất cả client về thành viên mới
+        join_message = f"{nickname} đã tham gia chat room!".encode('utf-8')
+        self.broadcast(join_message)
+        
+        # Gửi thông báo chào mừng cho client mới
+        welcome_message = f"Chào mừng {nickname}! Bạn đã kết nối thành công.".encode('utf-8')
+        client.send(welcome_message)
+        
+        self.handle_client(client)
+    
     def handle_client(self, client):
         """Xử lý tin nhắn từ một client"""
         while True:
@@ -56,7 +88,7 @@ class ChatServer:
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((self.host, self.port))
-        server.listen()
+        server.listen(self.backlog)
         
         print(f"[SERVER] Server đang chạy tại {self.host}:{self.port}")
         print("[SERVER] Đang chờ kết nối...")
@@ -67,26 +99,9 @@ class ChatServer:
                 client, address = server.accept()
                 print(f"[SERVER] Kết nối từ {str(address)}")
                 
-                # Yêu cầu client gửi nickname
-                client.send("NICK".encode('utf-8'))
-                nickname = client.recv(1024).decode('utf-8')
-                
-                # Thêm client vào danh sách
-                self.clients.append(client)
-                self.nicknames.append(nickname)
-                
-                print(f"[SERVER] {nickname} đã tham gia chat room")
-                
-                # Thông báo cho tất cả client về thành viên mới
-                join_message = f"{nickname} đã tham gia chat room!".encode('utf-8')
-                self.broadcast(join_message)
-                
-                # Gửi thông báo chào mừng cho client mới
-                welcome_message = f"Chào mừng {nickname}! Bạn đã kết nối thành công.".encode('utf-8')
-                client.send(welcome_message)
-                
-                # Tạo thread để xử lý client này
-                client_thread = threading.Thread(target=self.handle_client, args=(client,))
+                # Hỏi nickname trên thread riêng để vòng accept không bị chặn
+                # bởi client chậm gửi nickname
+                client_thread = threading.Thread(target=self.register_client, args=(client, address))
                 client_thread.daemon = True
                 client_thread.start()
                 
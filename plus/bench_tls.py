@@ -0,0 +1,157 @@
+"""Benchmark TLS cho chat server.
+
+Đo trên loopback với cert tự ký sinh bằng openssl:
+- Tốc độ full handshake (connections/s)
+- Tốc độ handshake được resume bằng session/ticket
+- Throughput chat (messages/s) qua TLS so với TCP thường
+
+Trước khi đo, kiểm tra client từ chối server có cert không do CA được tin ký.
+
+Chạy: python bench_tls.py [--handshakes 500] [--messages 20000] [--size 200]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from client_plus import AsyncChatClient, ChatProtocol, create_client_ssl_context
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def generate_certificate(directory, name='cert'):
+    """Sinh cert + key EC tự ký cho localhost"""
+    certfile = os.path.join(directory, f'{name}.pem')
+    keyfile = os.path.join(directory, f'{name}_key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'ec',
+        '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+        '-keyout', keyfile, '-out', certfile, '-days', '1',
+        '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+def start_server(port, certfile=None, keyfile=None):
+    """Chạy server_plus.py trong process riêng để không tranh GIL với client"""
+    cmd = [sys.executable, os.path.join(HERE, 'server_plus.py'),
+           '--host', '127.0.0.1', '--port', str(port)]
+    if certfile:
+        cmd += ['--tls-cert', certfile, '--tls-key', keyfile]
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server không khởi động được")
+
+def get_session(context, port):
+    """Đăng nhập 1 lần để nhận session ticket"""
+    with socket.create_connection(('127.0.0.1', port)) as raw:
+        with context.wrap_socket(raw, server_hostname='localhost') as tls:
+            tls.sendall(ChatProtocol.pack_message(ChatProtocol.LOGIN_REQUEST, 'bench_session'))
+            tls.recv(4096)
+            return tls.session
+
+def check_wrong_ca(port, other_cafile):
+    """Client tin CA khác phải thất bại ở handshake (không được đăng nhập)"""
+    context = create_client_ssl_context(other_cafile)
+    with socket.create_connection(('127.0.0.1', port)) as raw:
+        try:
+            with context.wrap_socket(raw, server_hostname='localhost'):
+                pass
+        except ssl.SSLCertVerificationError:
+            return True
+    return False
+
+def bench_handshakes(context, port, count, session=None):
+    """Trả về (handshakes/s, số lần được resume)"""
+    reused = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        with socket.create_connection(('127.0.0.1', port)) as raw:
+            with context.wrap_socket(raw, server_hostname='localhost', session=session) as tls:
+                reused += tls.session_reused
+    elapsed = time.perf_counter() - start
+    return count / elapsed, reused
+
+async def bench_throughput(port, messages, size, ssl_context=None):
+    """1 client gửi, 1 client nhận; trả về messages/s phía nhận"""
+    done = asyncio.get_running_loop().create_future()
+    received = 0
+
+    def on_receive(event):
+        nonlocal received
+        if event.type == ChatProtocol.CHAT_MESSAGE and event.data.get('nickname') == 'bench_tx':
+            received += 1
+            if received == messages and not done.done():
+                done.set_result(time.perf_counter())
+
+    receiver = AsyncChatClient('127.0.0.1', port, on_event=on_receive, ssl_context=ssl_context)
+    sender = AsyncChatClient('127.0.0.1', port, on_event=lambda event: None, ssl_context=ssl_context)
+    await receiver.connect()
+    await receiver.login('bench_rx')
+    await sender.connect()
+    await sender.login('bench_tx')
+
+    payload = 'x' * size
+    start = time.perf_counter()
+    for _ in range(messages):
+        await sender.send(payload)
+    end = await asyncio.wait_for(done, 120)
+
+    await sender.close()
+    await receiver.close()
+    return messages / (end - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=12450)
+    parser.add_argument('--handshakes', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=200, help="Độ dài mỗi tin nhắn")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = generate_certificate(directory)
+        other_cafile, _ = generate_certificate(directory, 'other')
+
+        plain = start_server(args.port)
+        try:
+            plain_rate = asyncio.run(bench_throughput(args.port, args.messages, args.size))
+        finally:
+            plain.terminate()
+            plain.wait()
+
+        tls_server = start_server(args.port + 1, certfile, keyfile)
+        try:
+            if not check_wrong_ca(args.port + 1, other_cafile):
+                sys.exit("[BENCH] LỖI: client chấp nhận cert không do CA được tin ký")
+            print("[BENCH] Cert sai CA bị từ chối: OK")
+            context = create_client_ssl_context(certfile)
+            full_rate, _ = bench_handshakes(context, args.port + 1, args.handshakes)
+            session = get_session(context, args.port + 1)
+            resumed_rate, reused = bench_handshakes(context, args.port + 1, args.handshakes, session)
+            tls_rate = asyncio.run(bench_throughput(args.port + 1, args.messages, args.size,
+                                                    create_client_ssl_context(certfile)))
+        finally:
+            tls_server.terminate()
+            tls_server.wait()
+
+    print(f"=== TLS benchmark ({ssl.OPENSSL_VERSION}) ===")
+    print(f"Full handshake:     {full_rate:10.1f} conn/s")
+    print(f"Resumed handshake:  {resumed_rate:10.1f} conn/s ({reused}/{args.handshakes} resumed)")
+    print(f"Throughput TCP:     {plain_rate:10.1f} msg/s ({args.size} bytes/msg)")
+    print(f"Throughput TLS:     {tls_rate:10.1f} msg/s")
+    print(f"Chi phí TLS:        {(1 - tls_rate / plain_rate) * 100:10.1f} %")
+
+if __name__ == "__main__":
+    main()
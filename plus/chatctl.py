@@ -0,0 +1,28 @@
+"""Gửi lệnh admin tới control socket của server_plus.py (--control-socket).
+
+Ví dụ:
+    python chatctl.py /tmp/chat.ctl stats
+    python chatctl.py /tmp/chat.ctl memory 10                 # client giữ nhiều bytes nhất
+    python chatctl.py /tmp/chat.ctl timing on
+    python chatctl.py /tmp/chat.ctl timing dump
+    python chatctl.py /tmp/chat.ctl profile 30 > stacks.txt   # flamegraph.pl stacks.txt > cpu.svg
+"""
+import socket
+import sys
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    path, command = sys.argv[1], ' '.join(sys.argv[2:])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall((command + '\n').encode('utf-8'))
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            sys.stdout.buffer.write(chunk)
+
+if __name__ == "__main__":
+    main()
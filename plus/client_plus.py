@@ -1,8 +1,15 @@
+import argparse
+import asyncio
+import os
 import socket
+import ssl
+import sys
 import threading
+import uuid
 import struct
 import json
 import time
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime
 
 class ChatProtocol:
@@ -20,6 +27,14 @@ class ChatProtocol:
     PING = 0x07
     PONG = 0x08
     ERROR = 0x09
+    SERVER_SHUTDOWN = 0x0A
+    SEND_ACK = 0x0B
+    STREAM_CHUNK = 0x0C
+    MCAST_NACK = 0x0D
+    MCAST_REPAIR = 0x0E
+    PRESENCE = 0x0F
+    SEARCH_REQUEST = 0x10
+    SEARCH_RESPONSE = 0x11
     
     @staticmethod
     def pack_message(msg_type, data):
@@ -71,26 +86,665 @@ class ChatProtocol:
         except Exception as e:
             raise ValueError(f"Failed to unpack message: {e}")
 
+class ResumableSSLContext(ssl.SSLContext):
+    """SSLContext phía client tự resume TLS session theo server_hostname.
+
+    asyncio không cho truyền session khi tạo kết nối, nên context giữ session
+    gần nhất của mỗi server và gắn vào wrap_bio(); reconnect hàng loạt không
+    phải trả giá full handshake.
+    """
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        # SSLContext nhận protocol ở __new__: không truyền thì thành PROTOCOL_TLS
+        # (CERT_NONE, không kiểm tra hostname)
+        return super().__new__(cls, protocol, *args, **kwargs)
+    
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        self.sessions = {}  # {server_hostname: SSLSession}
+    
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+def create_client_ssl_context(cafile=None, verify=True):
+    """Tạo context TLS cho client; cafile dùng cho cert tự ký"""
+    context = ResumableSSLContext()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+ChatEvent = namedtuple('ChatEvent', ['type', 'data'])
+
+class LoginError(Exception):
+    """Server từ chối yêu cầu đăng nhập"""
+    def __init__(self, error_code, error_message):
+        super().__init__(f"ERROR {error_code}: {error_message}")
+        self.error_code = error_code
+        self.error_message = error_message
+
+class MulticastReceiver(asyncio.DatagramProtocol):
+    """Nhận broadcast qua UDP multicast, sắp lại theo seq và xin sửa lỗi qua TCP.
+
+    Datagram: epoch (4) | seq (8) | flags (1) | frame. Seq bị thiếu được xin
+    lại bằng MCAST_NACK; server trả MCAST_REPAIR trên kết nối TCP. Event được
+    chuyển cho AsyncChatClient đúng thứ tự seq.
+    """
+    HEADER = struct.Struct('!IQB')
+    FRAME, FETCH, HEARTBEAT = 0, 1, 2
+    NACK_RETRY = 0.5  # Giây trước khi xin lại seq vẫn chưa có
+    NACK_LIMIT = 1024  # Tụt lại quá số seq này thì bỏ qua đoạn cũ
+    LOST = False  # Đánh dấu seq server báo đã mất
+    
+    def __init__(self, client, info):
+        self.client = client
+        self.group = info['group']
+        self.port = info['port']
+        self.epoch = info['epoch']
+        self.expected = info['seq'] + 1
+        self.buffered = {}  # {seq: ChatEvent | None (chờ FETCH) | LOST}
+        self.nacked = {}  # {seq: thời điểm xin lại gần nhất}
+        self.ready = deque()
+        self.wakeup = asyncio.Event()
+        self.transport = None
+        self.task = None
+    
+    async def start(self, interface='0.0.0.0'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            sock.bind((self.group, self.port))  # Linux: chỉ nhận datagram của group này
+        except OSError:
+            sock.bind(('', self.port))  # Windows không bind được địa chỉ multicast
+        membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.task = asyncio.create_task(self._deliver_loop())
+    
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.task is not None:
+            self.task.cancel()
+    
+    def datagram_received(self, datagram, addr):
+        if len(datagram) < self.HEADER.size:
+            return
+        epoch, seq, flags = self.HEADER.unpack_from(datagram)
+        if epoch != self.epoch:
+            # Server khởi động lại không qua hot restart => đồng bộ lại từ đây
+            self.epoch = epoch
+            self.expected = seq + 1 if flags == self.HEARTBEAT else seq
+            self.buffered.clear()
+            self.nacked.clear()
+        if flags == self.HEARTBEAT:
+            if seq >= self.expected:
+                self.request(self.expected, seq)
+            return
+        if seq < self.expected or self.buffered.get(seq) is not None:
+            return  # Trùng
+        if flags == self.FETCH:
+            self.buffered[seq] = None  # Frame quá lớn cho UDP, lấy qua TCP
+            self.request(seq, seq)
+        else:
+            try:
+                msg_type, msg_data = ChatProtocol.unpack_message(datagram[self.HEADER.size:])
+            except ValueError:
+                return
+            self.buffered[seq] = ChatEvent(msg_type, msg_data)
+        if seq > self.expected:
+            self.request(self.expected, seq - 1)
+        self.advance()
+    
+    def repair(self, data):
+        """MCAST_REPAIR từ kết nối TCP"""
+        if not isinstance(data, dict) or 'seq' not in data:
+            return
+        if data.get('lost'):
+            for seq in range(max(data['seq'], self.expected), data.get('to', data['seq']) + 1):
+                self.buffered[seq] = self.LOST
+        elif data['seq'] >= self.expected:
+            msg_data = data.get('data', '')
+            try:
+                msg_data = json.loads(msg_data)
+            except:
+                pass
+            self.buffered[data['seq']] = ChatEvent(data.get('type'), msg_data)
+        self.advance()
+    
+    def advance(self):
+        """Đưa các event liên tiếp từ expected sang hàng đợi giao"""
+        while self.expected in self.buffered and self.buffered[self.expected] is not None:
+            event = self.buffered.pop(self.expected)
+            self.nacked.pop(self.expected, None)
+            self.expected += 1
+            if event is not self.LOST:
+                self.ready.append(event)
+        if self.ready:
+            self.wakeup.set()
+    
+    def request(self, first, last):
+        """Gửi MCAST_NACK cho các seq trong [first, last] chưa có và chưa xin gần đây"""
+        if last - first >= self.NACK_LIMIT:
+            # Tụt lại quá xa: bỏ đoạn cũ, chỉ xin phần mới nhất
+            for seq in range(self.expected, last - self.NACK_LIMIT + 1):
+                self.buffered.pop(seq, None)
+            first = self.expected = last - self.NACK_LIMIT + 1
+        now = time.monotonic()
+        ranges = []
+        for seq in range(first, last + 1):
+            if self.buffered.get(seq) is not None or now - self.nacked.get(seq, 0) < self.NACK_RETRY:
+                continue
+            self.nacked[seq] = now
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1][1] = seq
+            else:
+                ranges.append([seq, seq])
+        if ranges and self.client.logged_in:
+            asyncio.ensure_future(self.client.send_message(ChatProtocol.MCAST_NACK, {"ranges": ranges}))
+        self.advance()
+    
+    async def _deliver_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.NACK_RETRY)
+            except asyncio.TimeoutError:
+                # Xin lại các seq còn thiếu mà repair chưa tới
+                if self.buffered:
+                    self.request(self.expected, max(self.buffered))
+                continue
+            self.wakeup.clear()
+            while self.ready:
+                event = self.ready.popleft()
+                if self.client.is_own_broadcast(event):
+                    continue
+                await self.client._dispatch(event)
+
+class AsyncChatClient:
+    """Client API bất đồng bộ (asyncio), không phụ thuộc input()/print.
+
+    Dùng cho bot và các service cần nhúng client:
+
+        client = AsyncChatClient(host, port)
+        await client.connect()
+        await client.login("bot")
+        await client.send("Hello!")
+        async for event in client:
+            print(event.type, event.data)
+
+    Nếu truyền on_event thì client chạy ở chế độ callback: mỗi event được
+    gọi thẳng vào callback (hàm thường hoặc coroutine) thay vì đưa vào hàng đợi.
+
+    Mỗi tin gửi đi có ID; server trả SEND_ACK thay vì echo lại cả tin, nhờ đó
+    đo được độ trễ gửi (latency_stats()). Với at_least_once=True, tin chưa được
+    ACK sẽ được gửi lại sau khi login lại, server bỏ bản trùng theo session.
+    
+    Với multicast=True (server chạy --multicast), broadcast được nhận qua UDP
+    multicast thay vì TCP; xem MulticastReceiver.
+    
+    presence: 'legacy' (USER_JOIN/USER_LEAVE/USER_LIST), 'batched' (1 frame
+    PRESENCE mỗi tick chỉ chứa thay đổi) hoặc 'none' (không nhận presence).
+    """
+    HIGH_WATER = 64 * 1024  # Chỉ chờ drain() khi buffer gửi vượt ngưỡng này
+    MAX_PENDING = 10000  # Số tin chưa ACK tối đa
+    CHUNK_SIZE = 16 * 1024  # Ký tự mỗi STREAM_CHUNK (server giới hạn 64K)
+
+    def __init__(self, host='localhost', port=12345, queue_size=1000,
+                 on_event=None, on_close=None, ssl_context=None, at_least_once=False,
+                 multicast=False, multicast_interface='0.0.0.0', presence='legacy'):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context  # None => TCP thường
+        self.nickname = ""
+        self.logged_in = False
+        self.user_list = []
+        self.reconnect_after = None  # Gợi ý (giây) từ SERVER_SHUTDOWN
+        self.at_least_once = at_least_once
+        self.session = uuid.uuid4().hex if at_least_once else None
+        self.multicast = multicast
+        self.multicast_interface = multicast_interface
+        self.receiver = None  # MulticastReceiver sau khi login
+        self.presence = presence
+        self._users = set()  # Danh sách có mặt dựng từ các frame PRESENCE
+        self.next_id = 1
+        self.next_stream = 1
+        self.pending = OrderedDict()  # {id: (message, thời điểm gửi)} chờ SEND_ACK
+        self.send_latencies = deque(maxlen=1000)  # Giây, từ lúc gửi tới khi có ACK
+        self._acked = asyncio.Event()
+        self.on_event = on_event
+        self.on_close = on_close
+        self.events = asyncio.Queue(maxsize=queue_size)  # Hàng đợi nhận có giới hạn
+        self._reader = None
+        self._writer = None
+        self._receive_task = None
+        self._login_future = None
+        self._closed = False
+
+    async def connect(self):
+        """Mở kết nối TCP và bắt đầu task nhận message"""
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context)
+        self._closed = False
+        self.reconnect_after = None
+        if not self.at_least_once:
+            self.pending.clear()  # Không gửi lại => bỏ theo dõi tin của kết nối cũ
+        self._receive_task = asyncio.create_task(self._receive_loop())
+
+    async def _receive_loop(self):
+        """Đọc từng frame (header 9 bytes + data) và dispatch event"""
+        error = None
+        try:
+            while True:
+                header = await self._reader.readexactly(9)
+                length = struct.unpack('!L', header[5:9])[0]
+                body = await self._reader.readexactly(length)
+                msg_type, msg_data = ChatProtocol.unpack_message(header + body)
+                await self._dispatch(ChatEvent(msg_type, msg_data))
+        except asyncio.IncompleteReadError:
+            pass  # Server đóng kết nối
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            error = e
+        finally:
+            self._closed = True
+            self.logged_in = False
+            if self._login_future and not self._login_future.done():
+                self._login_future.set_exception(ConnectionError("Mất kết nối với server"))
+            if self.on_event is None:
+                # Sentinel báo hết event; bỏ event cũ nhất nếu hàng đợi đầy
+                if self.events.full():
+                    self.events.get_nowait()
+                self.events.put_nowait(None)
+            if self.on_close:
+                self.on_close(error)
+
+    async def _dispatch(self, event):
+        """Cập nhật trạng thái client rồi chuyển event cho callback/hàng đợi"""
+        data = event.data
+        if event.type == ChatProtocol.LOGIN_RESPONSE:
+            if isinstance(data, dict) and data.get('success'):
+                self.logged_in = True
+                if data.get('multicast'):
+                    await self._join_multicast(data['multicast'])
+                # TLS 1.3 gửi session ticket sau handshake => lúc này đã có
+                self._remember_tls_session()
+                if self._login_future and not self._login_future.done():
+                    self._login_future.set_result(data)
+        elif event.type == ChatProtocol.ERROR:
+            if not self.logged_in and self._login_future and not self._login_future.done():
+                if isinstance(data, dict):
+                    error = LoginError(data.get('error_code', 0), data.get('error_message', 'Unknown error'))
+                else:
+                    error = LoginError(0, str(data))
+                self._login_future.set_exception(error)
+            elif isinstance(data, dict) and data.get('id') is not None:
+                # Tin bị server từ chối (vd bộ lọc nội dung): không gửi lại nữa
+                self.pending.pop(data['id'], None)
+        elif event.type == ChatProtocol.USER_LIST:
+            if isinstance(data, dict):
+                self.user_list = data.get('users', [])
+        elif event.type == ChatProtocol.PRESENCE:
+            if isinstance(data, dict):
+                if 'users' in data:
+                    self._users = set(data['users'])  # Ảnh chụp khi mới vào
+                self._users.update(data.get('joined', ()))
+                self._users.difference_update(data.get('left', ()))
+                self.user_list = sorted(self._users)
+        elif event.type == ChatProtocol.SERVER_SHUTDOWN:
+            if isinstance(data, dict):
+                self.reconnect_after = data.get('reconnect_after', 1.0)
+        elif event.type == ChatProtocol.MCAST_REPAIR:
+            if self.receiver is not None:
+                self.receiver.repair(data)
+            return  # Event đã sửa được giao theo thứ tự seq
+        elif event.type == ChatProtocol.SEND_ACK:
+            if isinstance(data, dict):
+                sent = self.pending.pop(data.get('id'), None)
+                if sent is not None:
+                    self.send_latencies.append(time.monotonic() - sent[1])
+                    self._acked.set()
+
+        if self.on_event:
+            result = self.on_event(event)
+            if asyncio.iscoroutine(result):
+                await result
+        else:
+            # Hàng đợi đầy => ngừng đọc socket (backpressure về phía server)
+            await self.events.put(event)
+
+    async def login(self, nickname, timeout=5.0):
+        """Đăng nhập; trả về LOGIN_RESPONSE hoặc raise LoginError/TimeoutError"""
+        self.nickname = nickname
+        self._login_future = asyncio.get_running_loop().create_future()
+        request = nickname
+        if self.at_least_once or self.multicast or self.presence != 'legacy':
+            request = {"nickname": nickname}
+            if self.at_least_once:
+                request["session"] = self.session
+            if self.multicast:
+                request["multicast"] = True
+            if self.presence != 'legacy':
+                request["presence"] = self.presence
+        try:
+            await self.send_message(ChatProtocol.LOGIN_REQUEST, request)
+            response = await asyncio.wait_for(self._login_future, timeout)
+        finally:
+            self._login_future = None
+        
+        # Gửi lại các tin chưa được ACK trước khi mất kết nối
+        for msg_id, (message, _) in self.pending.items():
+            await self.send_message(ChatProtocol.CHAT_MESSAGE, {"id": msg_id, "message": message})
+        return response
+
+    async def _join_multicast(self, info):
+        if self.receiver is not None:
+            self.receiver.close()
+        self.receiver = MulticastReceiver(self, info)
+        await self.receiver.start(self.multicast_interface)
+    
+    def is_own_broadcast(self, event):
+        """Multicast không loại được người gửi hay lọc theo kiểu presence như TCP
+        broadcast => lọc ở client"""
+        if event.type in (ChatProtocol.USER_JOIN, ChatProtocol.USER_LEAVE, ChatProtocol.USER_LIST):
+            if self.presence != 'legacy':
+                return True
+        elif event.type == ChatProtocol.PRESENCE and self.presence != 'batched':
+            return True
+        data = event.data
+        if not isinstance(data, dict):
+            return False
+        if event.type in (ChatProtocol.CHAT_MESSAGE, ChatProtocol.STREAM_CHUNK):
+            return data.get('nickname') == self.nickname
+        if event.type == ChatProtocol.USER_JOIN:
+            return self.nickname in data.get('nicknames', ())
+        if event.type == ChatProtocol.PRESENCE and self.nickname in data.get('joined', ()):
+            # TCP không gửi delta này cho người mới vào (đã có ảnh chụp) => bỏ tên mình,
+            # giữ thay đổi của người khác (data được decode riêng cho client này)
+            data['joined'] = [nickname for nickname in data['joined'] if nickname != self.nickname]
+            return not (data['joined'] or data.get('left'))
+        return False
+    
+    async def send_message(self, msg_type, data):
+        """Ghi frame vào transport; không chờ phản hồi để các lần gửi được pipeline"""
+        if self._writer is None or self._closed:
+            raise ConnectionError("Chưa kết nối tới server")
+        self._writer.write(ChatProtocol.pack_message(msg_type, data))
+        if self._writer.transport.get_write_buffer_size() > self.HIGH_WATER:
+            await self._writer.drain()
+
+    async def send(self, message):
+        """Gửi tin nhắn chat; trả về ID tin nhắn"""
+        if self.at_least_once:
+            # Chờ ACK bớt để không giữ quá nhiều tin chưa xác nhận
+            while len(self.pending) >= self.MAX_PENDING:
+                self._acked.clear()
+                await self._acked.wait()
+        elif len(self.pending) >= self.MAX_PENDING:
+            self.pending.popitem(last=False)  # Server cũ không gửi ACK
+        
+        msg_id = self.next_id
+        self.next_id += 1
+        self.pending[msg_id] = (message, time.monotonic())
+        await self.send_message(ChatProtocol.CHAT_MESSAGE, {"id": msg_id, "message": message})
+        return msg_id
+    
+    async def send_stream(self, source, name=None, chunk_size=None):
+        """Gửi payload lớn (string hoặc iterable các string, vd file mở ở text mode)
+        thành các STREAM_CHUNK; không cần giữ cả payload trong RAM. Trả về stream_id.
+
+        Server chuyển tiếp từng chunk ngay và xếp sau tin chat ở phía người nhận,
+        nên paste lớn không làm chậm chat.
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if isinstance(source, str):
+            text = source
+            source = (text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+        stream_id = str(self.next_stream)
+        self.next_stream += 1
+        
+        def pieces():
+            # Cắt lại theo chunk_size (dòng của file có thể dài hơn)
+            buffer = ''
+            for part in source:
+                buffer += part
+                while len(buffer) >= chunk_size:
+                    yield buffer[:chunk_size]
+                    buffer = buffer[chunk_size:]
+            yield buffer
+        
+        seq = 0
+        previous = None
+        for piece in pieces():
+            if previous is not None:
+                await self._send_chunk(stream_id, seq, previous, False, name)
+                seq += 1
+            previous = piece
+        await self._send_chunk(stream_id, seq, previous or '', True, name)
+        return stream_id
+    
+    async def _send_chunk(self, stream_id, seq, data, final, name):
+        chunk = {"stream_id": stream_id, "seq": seq, "final": final, "data": data}
+        if seq == 0 and name:
+            chunk["name"] = name
+        await self.send_message(ChatProtocol.STREAM_CHUNK, chunk)
+        await self._writer.drain()  # Bulk không chiếm buffer gửi của tin chat
+    
+    def latency_stats(self):
+        """Thống kê độ trễ gửi (ms) của các tin gần đây đã được ACK"""
+        samples = sorted(self.send_latencies)
+        if not samples:
+            return None
+        return {
+            "count": len(samples),
+            "avg_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": samples[len(samples) // 2] * 1000,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max_ms": samples[-1] * 1000
+        }
+
+    async def ping(self):
+        """Gửi PING"""
+        await self.send_message(ChatProtocol.PING, {"timestamp": time.time()})
+
+    async def search(self, query=None, nickname=None, since=None, until=None, before=None, limit=20):
+        """Gửi SEARCH_REQUEST; kết quả đến dưới dạng event SEARCH_RESPONSE"""
+        request = {"query": query, "nickname": nickname, "since": since,
+                   "until": until, "before": before, "limit": limit}
+        await self.send_message(ChatProtocol.SEARCH_REQUEST,
+                                {key: value for key, value in request.items() if value is not None})
+
+    @property
+    def tls_session_reused(self):
+        """True nếu kết nối TLS hiện tại được resume từ session cũ"""
+        ssl_object = self._writer.get_extra_info('ssl_object') if self._writer else None
+        return bool(ssl_object and ssl_object.session_reused)
+    
+    def _remember_tls_session(self):
+        if not isinstance(self.ssl_context, ResumableSSLContext) or self._writer is None:
+            return
+        ssl_object = self._writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None:
+            self.ssl_context.sessions[ssl_object.server_hostname] = ssl_object.session
+    
+    async def close(self):
+        """Đóng kết nối và dừng task nhận"""
+        self._remember_tls_session()
+        if self.receiver is not None:
+            self.receiver.close()
+            self.receiver = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            try:
+                await self._receive_task
+            except asyncio.CancelledError:
+                pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self.events.empty():
+            raise StopAsyncIteration
+        event = await self.events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+class Renderer:
+    """Hiển thị tách khỏi luồng nhận.
+
+    Luồng nhận chỉ gọi submit() (không format, không print). Thread renderer
+    lấy event theo lô, format và ghi ra terminal một lần cho cả lô. Khi terminal
+    không theo kịp, tin chat cũ nhất bị bỏ và hiển thị số tin đã bỏ qua.
+    """
+    def __init__(self, client, max_backlog=2000, batch_size=500, out=None):
+        self.client = client
+        self.max_backlog = max_backlog
+        self.batch_size = batch_size
+        self.out = out or sys.stdout
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.skipped = 0
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.render_loop)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self, timeout=1.0):
+        """Dừng renderer sau khi đã ghi nốt các event còn lại"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join(timeout)
+    
+    def submit(self, event):
+        """Gọi từ luồng nhận: chỉ enqueue, không bao giờ block"""
+        with self.cond:
+            self.pending.append(event)
+            if len(self.pending) > self.max_backlog:
+                self._collapse()
+            self.cond.notify()
+    
+    def _collapse(self):
+        """Bỏ tin chat cũ nhất, giữ lại các event khác (join/leave/error...)"""
+        kept = deque()
+        while len(self.pending) + len(kept) > self.max_backlog and self.pending:
+            event = self.pending.popleft()
+            if event.type == ChatProtocol.CHAT_MESSAGE:
+                self.skipped += 1
+            else:
+                kept.append(event)
+        kept.extend(self.pending)
+        self.pending = kept
+    
+    def render_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.pending and not self.running:
+                    break
+                count = min(len(self.pending), self.batch_size)
+                batch = [self.pending.popleft() for _ in range(count)]
+                skipped, self.skipped = self.skipped, 0
+            
+            # Trong 1 lô chỉ cần hiển thị USER_LIST mới nhất
+            last_user_list = None
+            for i, event in enumerate(batch):
+                if event.type == ChatProtocol.USER_LIST:
+                    last_user_list = i
+            
+            lines = []
+            if skipped:
+                lines.append(f"[INFO] ... bỏ qua {skipped} tin nhắn (hiển thị không theo kịp) ...")
+            self.client.render_buffer = lines
+            try:
+                for i, event in enumerate(batch):
+                    if event.type == ChatProtocol.USER_LIST and i != last_user_list:
+                        continue
+                    self.client.handle_received_message(event.type, event.data)
+            finally:
+                self.client.render_buffer = None
+            
+            if lines:
+                self.out.write('\n'.join(lines) + '\n')
+                self.out.flush()
+
 class ChatClient:
-    def __init__(self, host='localhost', port=12345):
+    """Client tương tác (CLI) - lớp mỏng bên trên AsyncChatClient.
+
+    Event loop của AsyncChatClient chạy trong 1 thread riêng, thread chính
+    chỉ đọc input() và gọi API qua run_coroutine_threadsafe. Với batched_render
+    (mặc định) việc format/print do Renderer làm, luồng nhận chỉ enqueue.
+    """
+    STREAM_DISPLAY_LIMIT = 100000  # Ký tự tối đa giữ lại để hiển thị của 1 stream
+    
+    def __init__(self, host='localhost', port=12345, batched_render=True, ssl_context=None,
+                 at_least_once=True, multicast=False, multicast_interface='0.0.0.0',
+                 presence='batched'):
         self.host = host
         self.port = port
+        self.ssl_context = ssl_context
+        self.at_least_once = at_least_once
+        self.multicast = multicast
+        self.multicast_interface = multicast_interface
+        self.presence = presence
         self.nickname = ""
-        self.client_socket = None
         self.running = False
         self.logged_in = False
         self.user_list = []
+        self.loop = None
+        self.api = None
+        self.renderer = Renderer(self) if batched_render else None
+        self.render_buffer = None  # Renderer gom output của 1 lô vào đây
+        self._ts_cache = (None, "")  # (giây, text): gán 1 lần để Renderer và thread nhập không lẫn nhau
+        self.streams = {}  # {(nickname, stream_id): {"name", "parts", "kept", "size"}} đang nhận dở
+        self.last_search = None  # SEARCH_REQUEST gần nhất, để /more lấy trang tiếp theo
         
     def format_timestamp(self, timestamp):
-        """Format timestamp thành string đẹp"""
-        dt = datetime.fromtimestamp(timestamp)
-        return dt.strftime("%H:%M:%S")
+        """Format timestamp thành string đẹp (cache theo từng giây)"""
+        second = int(timestamp)
+        cached_second, text = self._ts_cache
+        if second != cached_second:
+            text = datetime.fromtimestamp(second).strftime("%H:%M:%S")
+            self._ts_cache = (second, text)
+        return text
+    
+    def display(self, text):
+        """In 1 dòng ra terminal, hoặc gom vào lô hiện tại của Renderer"""
+        if self.render_buffer is not None:
+            self.render_buffer.append(text)
+        else:
+            print(text)
+    
+    def run_async(self, coro, timeout=None):
+        """Chạy coroutine trên event loop của client và chờ kết quả"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
     
     def send_message(self, msg_type, data):
         """Gửi message tới server"""
         try:
-            message = ChatProtocol.pack_message(msg_type, data)
-            self.client_socket.send(message)
+            self.run_async(self.api.send_message(msg_type, data), timeout=5)
             return True
         except Exception as e:
             print(f"[CLIENT] Lỗi gửi message: {e}")
@@ -102,12 +756,12 @@ class ChatClient:
             if data.get('success'):
                 self.logged_in = True
                 timestamp = self.format_timestamp(data.get('timestamp', time.time()))
-                print(f"[{timestamp}] {data.get('message', 'Đăng nhập thành công!')}")
-                print("-" * 50)
+                self.display(f"[{timestamp}] {data.get('message', 'Đăng nhập thành công!')}")
+                self.display("-" * 50)
             else:
-                print(f"[ERROR] Đăng nhập thất bại: {data.get('message', 'Unknown error')}")
+                self.display(f"[ERROR] Đăng nhập thất bại: {data.get('message', 'Unknown error')}")
         else:
-            print(f"[INFO] {data}")
+            self.display(f"[INFO] {data}")
     
     def handle_chat_message(self, data):
         """Xử lý tin nhắn chat"""
@@ -116,29 +770,28 @@ class ChatClient:
             message = data.get('message', '')
             timestamp = self.format_timestamp(data.get('timestamp', time.time()))
             
-            # Không in lại tin nhắn của chính mình (đã in khi gửi)
-            if nickname != self.nickname:
-                print(f"[{timestamp}] {nickname}: {message}")
+            # Server không echo tin của chính mình (chỉ gửi SEND_ACK) nên in hết
+            self.display(f"[{timestamp}] {nickname}: {message}")
         else:
-            print(f"[CHAT] {data}")
+            self.display(f"[CHAT] {data}")
     
     def handle_user_join(self, data):
         """Xử lý thông báo user tham gia"""
         if isinstance(data, dict):
             nickname = data.get('nickname', 'Unknown')
             timestamp = self.format_timestamp(data.get('timestamp', time.time()))
-            print(f"[{timestamp}] >>> {nickname} đã tham gia chat room <<<")
+            self.display(f"[{timestamp}] >>> {nickname} đã tham gia chat room <<<")
         else:
-            print(f"[JOIN] {data}")
+            self.display(f"[JOIN] {data}")
     
     def handle_user_leave(self, data):
         """Xử lý thông báo user rời đi"""
         if isinstance(data, dict):
             nickname = data.get('nickname', 'Unknown')
             timestamp = self.format_timestamp(data.get('timestamp', time.time()))
-            print(f"[{timestamp}] <<< {nickname} đã rời khỏi chat room >>>")
+            self.display(f"[{timestamp}] <<< {nickname} đã rời khỏi chat room >>>")
         else:
-            print(f"[LEAVE] {data}")
+            self.display(f"[LEAVE] {data}")
     
     def handle_user_list(self, data):
         """Xử lý danh sách users"""
@@ -147,7 +800,27 @@ class ChatClient:
             count = data.get('count', len(users))
             self.user_list = users
             
-            print(f"[INFO] Có {count} người trong chat room: {', '.join(users)}")
+            self.display(f"[INFO] Có {count} người trong chat room: {', '.join(users)}")
+    
+    def handle_presence(self, data):
+        """Xử lý PRESENCE (thay đổi trong 1 tick, hoặc ảnh chụp khi mới vào)"""
+        if not isinstance(data, dict):
+            return
+        timestamp = self.format_timestamp(data.get('timestamp', time.time()))
+        # AsyncChatClient đã cập nhật danh sách từ frame này
+        self.user_list = self.api.user_list
+        if 'users' in data:
+            self.display(f"[INFO] Có {data.get('count', len(self.user_list))} người trong chat room")
+        if data.get('joined'):
+            self.display(f"[{timestamp}] >>> {self.format_names(data['joined'])} đã tham gia chat room <<<")
+        if data.get('left'):
+            self.display(f"[{timestamp}] <<< {self.format_names(data['left'])} đã rời khỏi chat room >>>")
+    
+    @staticmethod
+    def format_names(nicknames, limit=10):
+        if len(nicknames) <= limit:
+            return ", ".join(nicknames)
+        return f"{', '.join(nicknames[:limit])} và {len(nicknames) - limit} người khác"
     
     def handle_error(self, data):
         """Xử lý thông báo lỗi"""
@@ -156,60 +829,177 @@ class ChatClient:
             error_message = data.get('error_message', 'Unknown error')
             timestamp = self.format_timestamp(data.get('timestamp', time.time()))
             
-            print(f"[{timestamp}] ERROR {error_code}: {error_message}")
+            self.display(f"[{timestamp}] ERROR {error_code}: {error_message}")
             
             # Nếu lỗi nickname exists, yêu cầu nhập lại
             if error_code == 409:  # NICKNAME_EXISTS
                 return False  # Signal to retry login
         else:
-            print(f"[ERROR] {data}")
+            self.display(f"[ERROR] {data}")
         return True
     
+    def handle_server_shutdown(self, data):
+        """Xử lý thông báo server tắt/khởi động lại"""
+        if isinstance(data, dict):
+            delay = data.get('reconnect_after', 1.0)
+            message = data.get('message', 'Server đang tắt')
+            self.display(f"[INFO] {message} (tự kết nối lại sau {delay:.1f}s)")
+        else:
+            self.display(f"[INFO] {data}")
+    
+    def collect_chunk(self, data):
+        """Ghép STREAM_CHUNK trên luồng nhận; trả về payload hoàn chỉnh ở chunk cuối"""
+        if not isinstance(data, dict):
+            return None
+        key = (data.get('nickname'), data.get('stream_id'))
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = {"name": data.get('name'), "parts": [], "kept": 0, "size": 0}
+        text = data.get('data', '')
+        stream['size'] += len(text)
+        if stream['kept'] < self.STREAM_DISPLAY_LIMIT:
+            text = text[:self.STREAM_DISPLAY_LIMIT - stream['kept']]
+            stream['parts'].append(text)
+            stream['kept'] += len(text)
+        if not data.get('final'):
+            return None
+        del self.streams[key]
+        return {
+            "nickname": key[0],
+            "name": stream['name'],
+            "data": ''.join(stream['parts']),
+            "size": stream['size'],
+            "aborted": bool(data.get('aborted')),
+            "timestamp": data.get('timestamp', time.time())
+        }
+    
+    def handle_stream(self, data):
+        """Hiển thị payload lớn (paste/file) đã nhận đủ"""
+        timestamp = self.format_timestamp(data['timestamp'])
+        title = data['name'] or 'paste'
+        if data['aborted']:
+            self.display(f"[{timestamp}] {data['nickname']}: [{title}] bị hủy giữa chừng")
+            return
+        self.display(f"[{timestamp}] {data['nickname']} gửi [{title}] ({data['size']} ký tự):")
+        self.display(data['data'])
+        if data['size'] > len(data['data']):
+            self.display(f"[INFO] ... cắt bớt, chỉ hiển thị {len(data['data'])}/{data['size']} ký tự ...")
+    
+    def handle_search_response(self, data):
+        """Hiển thị 1 trang kết quả tìm kiếm (mới nhất trước)"""
+        if not isinstance(data, dict):
+            return
+        hits = data.get('hits', [])
+        label = " ".join(filter(None, [data.get('query'), data.get('nickname') and '@' + data['nickname']]))
+        self.display(f"[SEARCH] {len(hits)} kết quả cho '{label}'")
+        for hit in hits:
+            when = datetime.fromtimestamp(hit.get('timestamp', 0)).strftime("%d/%m %H:%M:%S")
+            self.display(f"  #{hit.get('seq')} [{when}] {hit.get('nickname')}: {hit.get('message')}")
+        if self.last_search is not None:
+            self.last_search['before'] = data.get('next')
+        if data.get('next') is not None:
+            self.display("[SEARCH] Gõ /more để xem các kết quả cũ hơn")
+    
+    @staticmethod
+    def parse_age(text):
+        """'90s', '30m', '2h', '7d' => số giây; không hợp lệ => None"""
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+        try:
+            return float(text[:-1]) * units[text[-1]]
+        except (KeyError, ValueError, IndexError):
+            return None
+    
+    def send_search(self, args):
+        """/search từ khóa [@nickname] [since:2h] [until:30m]"""
+        words = []
+        request = {}
+        for word in args.split():
+            if word.startswith('@') and len(word) > 1:
+                request['nickname'] = word[1:]
+            elif word.startswith(('since:', 'until:')):
+                key, _, age = word.partition(':')
+                seconds = self.parse_age(age)
+                if seconds is None:
+                    print(f"[INFO] Thời gian không hợp lệ: {age} (vd 90s, 30m, 2h, 7d)")
+                    return
+                request[key] = time.time() - seconds
+            else:
+                words.append(word)
+        if words:
+            request['query'] = ' '.join(words)
+        if not request.get('query') and not request.get('nickname'):
+            print("[INFO] Cách dùng: /search từ khóa [@nickname] [since:2h] [until:30m]")
+            return
+        self.last_search = request
+        try:
+            self.run_async(self.api.search(**request), timeout=5)
+        except Exception as e:
+            print(f"[CLIENT] Lỗi gửi tìm kiếm: {e}")
+    
+    def search_more(self):
+        if not self.last_search or self.last_search.get('before') is None:
+            print("[INFO] Không còn kết quả nào")
+            return
+        try:
+            self.run_async(self.api.search(**self.last_search), timeout=5)
+        except Exception as e:
+            print(f"[CLIENT] Lỗi gửi tìm kiếm: {e}")
+    
     def handle_pong(self, data):
         """Xử lý PONG response"""
         # Có thể dùng để đo ping time
         pass
     
-    def receive_messages(self):
-        """Nhận và xử lý messages từ server"""
-        buffer = b''
-        
-        while self.running:
+    def on_event(self, event):
+        """Callback từ AsyncChatClient cho mỗi message nhận được"""
+        if event.type == ChatProtocol.STREAM_CHUNK:
+            # Chỉ đưa payload đã ghép đủ sang hiển thị
+            data = self.collect_chunk(event.data)
+            if data is None:
+                return
+            event = ChatEvent(ChatProtocol.STREAM_CHUNK, data)
+        if self.renderer:
+            self.renderer.submit(event)
+        else:
+            self.handle_received_message(event.type, event.data)
+    
+    def on_close(self, error):
+        """Callback khi kết nối tới server bị đóng"""
+        # Lỗi trước khi đăng nhập xong do login() tự báo
+        if self.running and self.logged_in and self.api.reconnect_after is not None:
+            # Server tắt có báo trước => chờ theo gợi ý rồi tự kết nối lại
+            self.logged_in = False
+            reconnect_thread = threading.Thread(target=self.reconnect,
+                                                args=(self.api.reconnect_after,))
+            reconnect_thread.daemon = True
+            reconnect_thread.start()
+            return
+        if not self.logged_in:
+            # Đóng trước khi đăng nhập xong (vd server đóng sau ERROR 409): login()
+            # tự kết nối lại hoặc báo lỗi, không được dừng input_loop ở đây
+            return
+        if self.running:
+            if error:
+                print(f"[CLIENT] Lỗi nhận message: {error}")
+            else:
+                print("[CLIENT] Mất kết nối với server")
+        self.running = False
+    
+    def reconnect(self, delay, max_retries=5):
+        """Kết nối và đăng nhập lại sau khi server khởi động lại"""
+        for attempt in range(max_retries):
+            time.sleep(delay)
+            if not self.running:
+                return
             try:
-                data = self.client_socket.recv(4096)
-                if not data:
-                    print("[CLIENT] Mất kết nối với server")
-                    break
-                
-                buffer += data
-                
-                # Process all complete messages in buffer
-                while len(buffer) >= 9:
-                    try:
-                        length = struct.unpack('!L', buffer[5:9])[0]
-                        total_msg_len = 9 + length
-                        
-                        if len(buffer) >= total_msg_len:
-                            # Extract complete message
-                            msg_bytes = buffer[:total_msg_len]
-                            buffer = buffer[total_msg_len:]
-                            
-                            # Process message
-                            msg_type, msg_data = ChatProtocol.unpack_message(msg_bytes)
-                            if msg_type is not None:
-                                self.handle_received_message(msg_type, msg_data)
-                        else:
-                            break  # Wait for more data
-                    except Exception as e:
-                        print(f"[CLIENT] Error processing buffer: {e}")
-                        buffer = b''
-                        break
-                        
+                self.run_async(self.api.connect(), timeout=10)
+                self.run_async(self.api.login(self.nickname, timeout=5))
+                self.logged_in = True
+                print("[CLIENT] Đã kết nối lại với server")
+                return
             except Exception as e:
-                if self.running:
-                    print(f"[CLIENT] Lỗi nhận message: {e}")
-                break
-                
+                print(f"[CLIENT] Kết nối lại thất bại ({attempt + 1}/{max_retries}): {e}")
+        print("[CLIENT] Không thể kết nối lại với server")
         self.running = False
     
     def handle_received_message(self, msg_type, data):
@@ -235,44 +1025,91 @@ class ChatClient:
         elif msg_type == ChatProtocol.PONG:
             self.handle_pong(data)
         
+        elif msg_type == ChatProtocol.SERVER_SHUTDOWN:
+            self.handle_server_shutdown(data)
+        
+        elif msg_type == ChatProtocol.SEND_ACK:
+            pass  # AsyncChatClient đã ghi nhận ACK và độ trễ
+        
+        elif msg_type == ChatProtocol.STREAM_CHUNK:
+            self.handle_stream(data)
+        
+        elif msg_type == ChatProtocol.PRESENCE:
+            self.handle_presence(data)
+        
+        elif msg_type == ChatProtocol.SEARCH_RESPONSE:
+            self.handle_search_response(data)
+        
         else:
-            print(f"[CLIENT] Unknown message type: {msg_type}")
+            self.display(f"[CLIENT] Unknown message type: {msg_type}")
         
         return True
     
     def send_chat_message(self, message):
         """Gửi tin nhắn chat"""
         if self.logged_in and message.strip():
-            if self.send_message(ChatProtocol.CHAT_MESSAGE, message):
-                # In tin nhắn của chính mình
-                timestamp = self.format_timestamp(time.time())
-                print(f"[{timestamp}] {self.nickname}: {message}")
-                return True
+            # Gửi {id, message} qua api.send để có SEND_ACK, gửi lại và /latency;
+            # server không echo tin có id nên tự in tin của mình
+            try:
+                self.run_async(self.api.send(message), timeout=5)
+            except Exception as e:
+                print(f"[CLIENT] Lỗi gửi message: {e}")
+                return False
+            timestamp = self.format_timestamp(time.time())
+            print(f"[{timestamp}] {self.nickname}: {message}")
+            return True
         return False
     
     def login(self):
-        """Đăng nhập với nickname"""
+        """Đăng nhập với nickname (chờ theo event, không polling)"""
         max_retries = 3
         for attempt in range(max_retries):
             if attempt > 0:
                 print(f"\nThử lại lần {attempt + 1}/{max_retries}")
             
-            # Send login request
-            if self.send_message(ChatProtocol.LOGIN_REQUEST, self.nickname):
-                # Wait for response (timeout after 5 seconds)
-                start_time = time.time()
-                while time.time() - start_time < 5:
-                    if self.logged_in:
-                        return True
-                    time.sleep(0.1)
-                
-                if not self.logged_in:
-                    print("[ERROR] Timeout waiting for login response")
-            else:
-                print("[ERROR] Không thể gửi login request")
+            try:
+                self.run_async(self.api.login(self.nickname, timeout=5))
+                self.logged_in = True
+                return True
+            except LoginError as e:
+                # Nickname trùng thì cho nhập lại, lỗi khác thì dừng
+                if e.error_code != 409:
+                    return False
+                self.nickname = input("Nhập nickname khác: ").strip()
+                if not self.nickname:
+                    return False
+                # Server đóng kết nối sau khi từ chối login => kết nối lại
+                self.run_async(self.api.close(), timeout=2)
+                self.run_async(self.api.connect(), timeout=10)
+            except (asyncio.TimeoutError, TimeoutError):
+                print("[ERROR] Timeout waiting for login response")
+            except Exception as e:
+                print(f"[ERROR] Không thể gửi login request: {e}")
+                return False
         
         return False
     
+    def send_paste(self, path=None):
+        """Gửi nội dung file hoặc nhiều dòng nhập vào dưới dạng stream"""
+        try:
+            if path:
+                with open(path, encoding='utf-8', errors='replace') as source:
+                    self.run_async(self.api.send_stream(source, name=os.path.basename(path)))
+                print(f"[INFO] Đã gửi {path}")
+            else:
+                print("[INFO] Nhập nội dung, kết thúc bằng 1 dòng chỉ có '.'")
+                lines = []
+                while True:
+                    line = input()
+                    if line == '.':
+                        break
+                    lines.append(line + '\n')
+                if lines:
+                    self.run_async(self.api.send_stream(''.join(lines)))
+                    print(f"[INFO] Đã gửi {len(lines)} dòng")
+        except Exception as e:
+            print(f"[CLIENT] Lỗi gửi paste: {e}")
+    
     def send_ping(self):
         """Gửi PING để test connection"""
         ping_data = {"timestamp": time.time()}
@@ -284,6 +1121,7 @@ class ChatClient:
             return False
         
         cmd = message.lower().split()[0]
+        args = message.split(maxsplit=1)[1:]
         
         if cmd in ['/quit', '/exit', '/q']:
             return 'quit'
@@ -300,11 +1138,36 @@ class ChatClient:
                 print("[INFO] Không có thông tin danh sách users")
             return 'continue'
         
+        elif cmd == '/latency':
+            stats = self.api.latency_stats()
+            if stats:
+                print(f"[INFO] Độ trễ gửi ({stats['count']} tin): avg {stats['avg_ms']:.1f}ms, "
+                      f"p50 {stats['p50_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms, max {stats['max_ms']:.1f}ms")
+            else:
+                print("[INFO] Chưa có tin nhắn nào được server xác nhận")
+            return 'continue'
+        
+        elif cmd == '/paste':
+            self.send_paste(args[0] if args else None)
+            return 'continue'
+        
+        elif cmd == '/search':
+            self.send_search(args[0] if args else '')
+            return 'continue'
+        
+        elif cmd == '/more':
+            self.search_more()
+            return 'continue'
+        
         elif cmd == '/help':
             print("\n=== COMMANDS ===")
             print("/quit, /exit, /q - Thoát khỏi chat")
             print("/ping - Test connection")
             print("/users, /list - Xem danh sách users")
+            print("/latency - Xem độ trễ gửi tin nhắn")
+            print("/paste [file] - Gửi nội dung file, hoặc nhiều dòng (kết thúc bằng dòng '.')")
+            print("/search từ khóa [@nickname] [since:2h] [until:30m] - Tìm tin nhắn cũ")
+            print("/more - Trang kết quả tìm kiếm tiếp theo")
             print("/help - Hiển thị help")
             print("===============\n")
             return 'continue'
@@ -344,17 +1207,26 @@ class ChatClient:
     def connect_and_run(self):
         """Kết nối tới server và chạy client"""
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.host, self.port))
+            self.loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=self.loop.run_forever)
+            loop_thread.daemon = True
+            loop_thread.start()
+            if self.renderer:
+                self.renderer.start()
+            
+            self.api = AsyncChatClient(self.host, self.port,
+                                       on_event=self.on_event,
+                                       on_close=self.on_close,
+                                       ssl_context=self.ssl_context,
+                                       at_least_once=self.at_least_once,
+                                       multicast=self.multicast,
+                                       multicast_interface=self.multicast_interface,
+                                       presence=self.presence)
+            self.run_async(self.api.connect(), timeout=10)
             self.running = True
             
             print(f"[CLIENT] Đã kết nối tới server {self.host}:{self.port}")
             
-            # Start receive thread
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
             # Login
             if self.login():
                 print("Bạn có thể bắt đầu chat! Gõ /help để xem lệnh hỗ trợ")
@@ -371,17 +1243,36 @@ class ChatClient:
     
     def disconnect(self):
         """Ngắt kết nối"""
+        if self.loop is None:
+            return
         print("\n[CLIENT] Đang ngắt kết nối...")
         self.running = False
         self.logged_in = False
         
-        if self.client_socket:
+        if self.api:
             try:
-                self.client_socket.close()
+                self.run_async(self.api.close(), timeout=2)
             except:
                 pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+        if self.renderer:
+            self.renderer.stop()
 
 def main():
+    parser = argparse.ArgumentParser(description="Chat client (Improved Protocol)")
+    parser.add_argument('--tls', action='store_true', help="Kết nối qua TLS")
+    parser.add_argument('--cafile', help="CA/cert tự ký để xác thực server")
+    parser.add_argument('--insecure', action='store_true', help="Bỏ qua xác thực cert (chỉ để test)")
+    parser.add_argument('--multicast', action='store_true', help="Nhận broadcast qua UDP multicast (server chạy --multicast)")
+    parser.add_argument('--multicast-if', default='0.0.0.0', help="IP interface join group (127.0.0.1 để test loopback)")
+    parser.add_argument('--presence', choices=['batched', 'legacy', 'none'], default='batched',
+                        help="Kiểu thông báo vào/ra: batched (gộp theo tick), legacy, none (tắt)")
+    args = parser.parse_args()
+    ssl_context = None
+    if args.tls or args.cafile:
+        ssl_context = create_client_ssl_context(args.cafile, verify=not args.insecure)
+    
     print("=== CHAT CLIENT (Improved Protocol) ===")
     print("Protocol version:", ChatProtocol.VERSION)
     
@@ -411,7 +1302,9 @@ def main():
         port = 12345
     
     # Create and run client
-    client = ChatClient(host, port)
+    client = ChatClient(host, port, ssl_context=ssl_context,
+                        multicast=args.multicast, multicast_interface=args.multicast_if,
+                        presence=args.presence)
     client.nickname = nickname
     
     print(f"\nĐang kết nối tới {host}:{port}...")
@@ -0,0 +1,281 @@
+"""Phát lại trace ghi bởi `server_plus.py --capture` để kiểm tra hồi quy hiệu năng.
+
+Mỗi connection trong trace được tạo lại bằng 1 kết nối TCP mới tới server cần
+đo và gửi lại đúng các frame (bytes gốc của ChatProtocol) theo thứ tự ghi.
+Trace được đọc tuần tự nên file lớn không phải nạp hết vào RAM.
+
+Chạy:
+    python replay.py trace.bin --port 12345 --output build_a.json            # thời gian thực
+    python replay.py trace.bin --port 12345 --fast --output build_b.json     # nhanh nhất có thể
+    python replay.py --compare build_a.json build_b.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+from collections import OrderedDict
+
+from server_plus import ChatProtocol, TraceWriter
+
+TYPE_NAMES = {value: name for name, value in vars(ChatProtocol).items()
+              if name.isupper() and isinstance(value, int) and value < 0x100
+              and not name.startswith(('MAGIC', 'VERSION', 'ERROR_'))}
+
+def read_trace(path):
+    """Đọc tuần tự từng record (kind, conn_id, t_us, payload)"""
+    record_size = TraceWriter.RECORD.size
+    with open(path, 'rb') as trace:
+        header = trace.read(len(TraceWriter.MAGIC) + 8)
+        if header[:len(TraceWriter.MAGIC)] != TraceWriter.MAGIC:
+            raise ValueError(f"{path} không phải file trace")
+        while True:
+            head = trace.read(record_size)
+            if len(head) < record_size:
+                return
+            kind, conn_id, t_us, length = TraceWriter.RECORD.unpack(head)
+            yield kind, conn_id, t_us, trace.read(length) if length else b''
+
+class Reservoir:
+    """Giữ mẫu ngẫu nhiên tối đa size giá trị (bộ nhớ cố định)"""
+    def __init__(self, size=100000):
+        self.size = size
+        self.samples = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.size:
+                self.samples[index] = value
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"count": 0}
+        pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+        return {
+            "count": self.seen,
+            "avg_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": pick(0.50),
+            "p90_ms": pick(0.90),
+            "p99_ms": pick(0.99),
+            "max_ms": samples[-1] * 1000
+        }
+
+class ReplayConnection:
+    """1 connection trong trace: gửi lại frame theo thứ tự, đếm frame nhận được"""
+    QUEUE_SIZE = 256  # Frame chờ gửi; đầy thì vòng đọc trace chờ (không nạp cả trace)
+
+    def __init__(self, replayer, conn_id):
+        self.replayer = replayer
+        self.conn_id = conn_id
+        self.nickname = None
+        self.sent_ids = {}  # {message id: thời điểm gửi} để đo độ trễ SEND_ACK
+        self.queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        replayer = self.replayer
+        try:
+            reader, writer = await asyncio.open_connection(replayer.host, replayer.port)
+        except OSError:
+            replayer.failed_connections += 1
+            while await self.queue.get() is not None:
+                pass
+            return
+
+        receive_task = asyncio.create_task(self.receive_loop(reader))
+        while True:
+            frame = await self.queue.get()
+            if frame is None:
+                break
+            self.note_sent(frame)
+            writer.write(frame)
+            replayer.frames_sent += 1
+            if writer.transport.get_write_buffer_size() > 64 * 1024:
+                await writer.drain()
+
+        # Đợi thêm 1 chút để nhận nốt phản hồi rồi mới đóng
+        await asyncio.sleep(replayer.settle)
+        receive_task.cancel()
+        writer.close()
+
+    def note_sent(self, frame):
+        """Ghi nhận nickname và thời điểm gửi để đo độ trễ khi nhận lại"""
+        msg_type = frame[4]
+        if msg_type not in (ChatProtocol.LOGIN_REQUEST, ChatProtocol.CHAT_MESSAGE):
+            return
+        try:
+            _, data = ChatProtocol.unpack_message(frame)
+        except ValueError:
+            return
+        now = time.monotonic()
+        if msg_type == ChatProtocol.LOGIN_REQUEST:
+            self.nickname = data.get('nickname') if isinstance(data, dict) else str(data).strip()
+        elif isinstance(data, dict):
+            if data.get('id') is not None:
+                self.sent_ids[data['id']] = now
+            self.replayer.note_chat(self.nickname, data.get('message'), now)
+        else:
+            self.replayer.note_chat(self.nickname, data, now)
+
+    async def receive_loop(self, reader):
+        replayer = self.replayer
+        try:
+            while True:
+                header = await reader.readexactly(9)
+                length = struct.unpack('!L', header[5:9])[0]
+                body = await reader.readexactly(length)
+                msg_type = header[4]
+                replayer.delivered[msg_type] = replayer.delivered.get(msg_type, 0) + 1
+                if msg_type == ChatProtocol.CHAT_MESSAGE:
+                    data = json.loads(body)
+                    replayer.note_delivery(data.get('nickname'), data.get('message'))
+                elif msg_type == ChatProtocol.SEND_ACK:
+                    sent = self.sent_ids.pop(json.loads(body).get('id'), None)
+                    if sent is not None:
+                        replayer.ack_latency.add(time.monotonic() - sent)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+class Replayer:
+    SENT_LIMIT = 100000  # Số tin gần nhất giữ thời điểm gửi để ghép với lúc nhận
+
+    def __init__(self, host, port, speed=1.0, fast=False, settle=1.0):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.fast = fast
+        self.settle = settle
+        self.connections = {}
+        self.total_connections = 0
+        self.failed_connections = 0
+        self.frames_sent = 0
+        self.delivered = {}  # {msg_type: số frame nhận được}
+        self.sent_at = OrderedDict()  # {(nickname, message): thời điểm gửi gần nhất}
+        self.delivery_latency = Reservoir()
+        self.ack_latency = Reservoir()
+
+    def note_chat(self, nickname, message, now):
+        key = (nickname, str(message))
+        self.sent_at[key] = now
+        self.sent_at.move_to_end(key)
+        if len(self.sent_at) > self.SENT_LIMIT:
+            self.sent_at.popitem(last=False)
+
+    def note_delivery(self, nickname, message):
+        sent = self.sent_at.get((nickname, str(message)))
+        if sent is not None:
+            self.delivery_latency.add(time.monotonic() - sent)
+
+    async def run(self, path):
+        start = time.monotonic()
+        for kind, conn_id, t_us, payload in read_trace(path):
+            if not self.fast:
+                delay = start + t_us / 1000000 / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            if kind == TraceWriter.OPEN:
+                self.connections[conn_id] = ReplayConnection(self, conn_id)
+                self.total_connections += 1
+            elif kind == TraceWriter.FRAME:
+                connection = self.connections.get(conn_id)
+                if connection is not None:
+                    await connection.queue.put(payload)
+            elif kind == TraceWriter.CLOSE:
+                connection = self.connections.pop(conn_id, None)
+                if connection is not None:
+                    await connection.queue.put(None)
+
+        # Connection còn mở ở cuối trace
+        for connection in self.connections.values():
+            await connection.queue.put(None)
+        tasks = [connection.task for connection in self.connections.values()]
+        self.connections.clear()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(self.settle)
+        return time.monotonic() - start
+
+    def summary(self, duration):
+        return {
+            "duration_s": duration,
+            "connections": self.total_connections,
+            "failed_connections": self.failed_connections,
+            "frames_sent": self.frames_sent,
+            "delivered": {TYPE_NAMES.get(t, str(t)): n for t, n in sorted(self.delivered.items())},
+            "delivery_latency": self.delivery_latency.summary(),
+            "ack_latency": self.ack_latency.summary()
+        }
+
+def compare(base_path, new_path):
+    """In chênh lệch số frame nhận được và phân bố độ trễ giữa 2 lần replay"""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def row(name, a, b):
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a:
+            change = f"{(b - a) / a * 100:+.1f}%"
+        else:
+            change = ""
+        print(f"{name:<28}{a!s:>14}{b!s:>14}{change:>10}")
+
+    print(f"{'':<28}{'base':>14}{'new':>14}{'change':>10}")
+    for key in ('duration_s', 'connections', 'failed_connections', 'frames_sent'):
+        row(key, round(base[key], 3), round(new[key], 3))
+    for name in sorted(set(base['delivered']) | set(new['delivered'])):
+        row(f"delivered.{name}", base['delivered'].get(name, 0), new['delivered'].get(name, 0))
+    for metric in ('delivery_latency', 'ack_latency'):
+        for key in ('count', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'):
+            a, b = base[metric].get(key), new[metric].get(key)
+            if a is not None or b is not None:
+                row(f"{metric}.{key}", round(a or 0, 3), round(b or 0, 3))
+
+def raise_fd_limit():
+    """Hàng chục nghìn connection cần nâng giới hạn số fd (Unix)"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay trace của chat server")
+    parser.add_argument('trace', nargs='?', help="File trace từ server_plus.py --capture")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--fast', action='store_true', help="Phát nhanh nhất có thể, bỏ qua thời gian gốc")
+    parser.add_argument('--speed', type=float, default=1.0, help="Hệ số tốc độ khi phát theo thời gian thực")
+    parser.add_argument('--settle', type=float, default=1.0, help="Giây chờ nhận nốt phản hồi trước khi đóng")
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="So sánh 2 file kết quả")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.trace:
+        parser.error("cần file trace hoặc --compare")
+
+    raise_fd_limit()
+    replayer = Replayer(args.host, args.port, args.speed, args.fast, args.settle)
+    duration = asyncio.run(replayer.run(args.trace))
+    result = replayer.summary(duration)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
+import asyncio
+import argparse
+import base64
+import os
+import queue
+import random
+import re
+import select
+import selectors
+import signal
 import socket
+import ssl
+import sys
 import threading
 import struct
 import json
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime
 
 class ChatProtocol:
@@ -20,12 +35,22 @@ class ChatProtocol:
     PING = 0x07
     PONG = 0x08
     ERROR = 0x09
+    SERVER_SHUTDOWN = 0x0A
+    SEND_ACK = 0x0B
+    STREAM_CHUNK = 0x0C
+    MCAST_NACK = 0x0D
+    MCAST_REPAIR = 0x0E
+    PRESENCE = 0x0F
+    SEARCH_REQUEST = 0x10
+    SEARCH_RESPONSE = 0x11
     
     # Error codes
     ERROR_BAD_REQUEST = 400
     ERROR_UNAUTHORIZED = 401
+    ERROR_FORBIDDEN = 403
     ERROR_NICKNAME_EXISTS = 409
     ERROR_SERVER_ERROR = 500
+    ERROR_SERVER_BUSY = 503
     
     @staticmethod
     def pack_message(msg_type, data):
@@ -77,43 +102,1157 @@ class ChatProtocol:
         except Exception as e:
             raise ValueError(f"Failed to unpack message: {e}")
 
+def create_server_ssl_context(certfile, keyfile=None):
+    """Tạo SSLContext phía server (TLS 1.2+, có session ticket để resume)"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # TLS 1.3: gửi ticket sau handshake để client reconnect không phải full handshake
+    context.num_tickets = 2
+    # Kernel TLS (OpenSSL 3 + Python 3.12+): offload mã hóa record xuống kernel nếu có
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return context
+
+ServerEvent = namedtuple('ServerEvent', ['room', 'type', 'data'])
+
+class Subscription:
+    """Subscriber trong cùng tiến trình với ChatServer (không qua socket).
+
+    Event (ServerEvent) được đưa vào hàng đợi có giới hạn; subscriber chậm chỉ
+    làm mất event cũ nhất của chính nó (đếm trong dropped), không bao giờ làm
+    chậm fan-out tới các client. data là object đã decode, dùng chung giữa các
+    subscriber nên chỉ được đọc, không sửa.
+
+    Cách dùng:
+    - Tạo trong coroutine: `async for event in sub`
+    - Tạo từ thread thường: `for event in sub` hoặc `sub.get(timeout)`
+    - Có callback: callback(event) chạy trên thread riêng của subscription
+    """
+    def __init__(self, server, filter=None, callback=None, maxsize=1000):
+        self.server = server
+        self.filter = filter
+        self.callback = callback
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.loop = None
+        self.async_queue = None
+        
+        if callback is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+                self.async_queue = asyncio.Queue()
+            except RuntimeError:
+                pass  # Không có event loop => chế độ đồng bộ
+        else:
+            dispatcher = threading.Thread(target=self._dispatch_loop)
+            dispatcher.daemon = True
+            dispatcher.start()
+    
+    def matches(self, event):
+        """filter: None (tất cả), callable(event) -> bool, hoặc tập các msg type"""
+        if self.filter is None:
+            return True
+        if callable(self.filter):
+            return self.filter(event)
+        return event.type in self.filter
+    
+    def deliver(self, event):
+        """Gọi từ thread fan-out của server: không bao giờ block"""
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._put_async, event)
+            except RuntimeError:
+                self.close()  # Event loop của subscriber đã đóng
+            return
+        with self.cond:
+            if len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(event)
+            self.cond.notify()
+    
+    def _put_async(self, event):
+        if self.async_queue.qsize() >= self.maxsize:
+            self.async_queue.get_nowait()
+            self.dropped += 1
+        self.async_queue.put_nowait(event)
+    
+    def get(self, timeout=None):
+        """Lấy 1 event (chế độ đồng bộ); trả về None khi hết thời gian hoặc đã close"""
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait(timeout)
+            if self.queue:
+                return self.queue.popleft()
+            return None
+    
+    def _dispatch_loop(self):
+        while True:
+            event = self.get()
+            if event is None:
+                if self.closed:
+                    break
+                continue
+            try:
+                self.callback(event)
+            except Exception as e:
+                print(f"[SERVER] Lỗi trong subscriber callback: {e}")
+    
+    def close(self):
+        """Hủy đăng ký"""
+        self.server.unsubscribe(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.async_queue.put_nowait, None)
+            except RuntimeError:
+                pass
+    
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                if self.closed:
+                    return
+                continue
+            yield event
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        if self.async_queue is None:
+            # Event đã được đưa vào hàng đợi đồng bộ/callback từ lúc tạo, không chuyển sang loop được
+            raise TypeError("Subscription không được tạo trong event loop (hoặc có callback): "
+                            "dùng `for event in sub`/sub.get(), hoặc subscribe() trong coroutine")
+        if self.closed and self.async_queue.empty():
+            raise StopAsyncIteration
+        event = await self.async_queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+class TraceWriter:
+    """Ghi lại các frame client gửi lên để replay (xem replay.py).
+
+    Format file: MAGIC (8 bytes) + thời điểm bắt đầu (double), sau đó là các
+    record: kind (1) | conn_id (4) | t_us từ lúc bắt đầu (8) | length (4) | bytes.
+    Frame được ghi nguyên dạng bytes của ChatProtocol.
+    """
+    MAGIC = b'CHTRACE1'
+    OPEN = 1
+    FRAME = 2
+    CLOSE = 3
+    RECORD = struct.Struct('!BIQI')
+    
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(self.MAGIC + struct.pack('!d', time.time()))
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.conn_ids = {}  # {client_socket: conn_id}
+        self.next_id = 1
+        self.last_flush = self.start
+    
+    def record(self, kind, client_socket, payload=b''):
+        with self.lock:
+            if self.file.closed:
+                return
+            if kind == self.OPEN:
+                conn_id = self.conn_ids[client_socket] = self.next_id
+                self.next_id += 1
+            elif kind == self.CLOSE:
+                conn_id = self.conn_ids.pop(client_socket, None)
+            else:
+                conn_id = self.conn_ids.get(client_socket)
+            if conn_id is None:
+                return
+            now = time.monotonic()
+            self.file.write(self.RECORD.pack(kind, conn_id, int((now - self.start) * 1000000), len(payload)))
+            if payload:
+                self.file.write(payload)
+            # Flush mỗi giây để trace vẫn dùng được nếu process bị kill
+            if now - self.last_flush > 1.0:
+                self.file.flush()
+                self.last_flush = now
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class SamplingProfiler:
+    """Profiler lấy mẫu stack của mọi thread bằng sys._current_frames().
+
+    Chỉ chạy trong thời gian được yêu cầu; ngoài lúc đó không có chi phí gì.
+    Kết quả là collapsed stacks ("thread;file:func;... count") dùng trực tiếp
+    cho flamegraph.pl / speedscope. Là profile theo wall-clock nên thời gian
+    chờ lock hay chờ socket cũng hiện ra.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}  # {collapsed stack: số mẫu}
+        self.samples = 0
+
+    def run(self, duration):
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            # "Thread-12 (login_worker)" => "login_worker" để các worker gộp chung 1 nhánh
+            names = {thread.ident: thread.name.rsplit('(', 1)[-1].rstrip(')')
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in
+                         sorted(self.counts.items(), key=lambda item: -item[1]))
+
+class HandlerTimer:
+    """Histogram thời gian chạy của các handler, bật/tắt lúc runtime.
+
+    Khi bật, các method trong HANDLERS được bọc bằng instance attribute (che
+    method của class); khi tắt thì xóa attribute đó đi nên lời gọi quay về
+    method gốc, không còn lớp bọc hay phép kiểm tra nào.
+    """
+    HANDLERS = ('handle_login_request', 'handle_chat_message', 'handle_stream_chunk',
+                'handle_client_message', 'broadcast', 'send_to_client', 'flush_presence',
+                'handle_search_request', 'remove_client')
+    BUCKETS = 24  # Bucket i: < 2^i µs (tới ~8 giây)
+
+    def __init__(self, server):
+        self.server = server
+        self.enabled = False
+        self.lock = threading.Lock()
+        # {handler: [count, tổng giây, max giây, [bucket counts]]}
+        self.stats = {name: [0, 0.0, 0.0, [0] * self.BUCKETS] for name in self.HANDLERS}
+
+    def reset(self):
+        with self.lock:
+            # Xóa tại chỗ: lớp bọc đang cài giữ tham chiếu tới dict này
+            for entry in self.stats.values():
+                entry[:] = [0, 0.0, 0.0, [0] * self.BUCKETS]
+
+    def wrap(self, name, method):
+        stats = self.stats
+        lock = self.lock
+        last = self.BUCKETS - 1
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                bucket = min(int(elapsed * 1000000).bit_length(), last)
+                with lock:
+                    entry = stats[name]
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    if elapsed > entry[2]:
+                        entry[2] = elapsed
+                    entry[3][bucket] += 1
+        return timed
+
+    def enable(self):
+        if not self.enabled:
+            for name in self.HANDLERS:
+                setattr(self.server, name, self.wrap(name, getattr(type(self.server), name).__get__(self.server)))
+            self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            for name in self.HANDLERS:
+                self.server.__dict__.pop(name, None)
+            self.enabled = False
+
+    def dump(self):
+        """Bảng count/avg/p50/p99/max (µs) cho từng handler"""
+        def percentile(buckets, count, q, peak_us):
+            # Cận trên của bucket chứa percentile, không vượt quá max đã đo
+            # (bucket cuối không có cận trên nên dùng luôn max)
+            target = count * q
+            seen = 0
+            for i, n in enumerate(buckets[:-1]):
+                seen += n
+                if seen >= target:
+                    return min((1 << i) if i else 1, peak_us)
+            return peak_us
+
+        lines = [f"{'handler':<24}{'count':>10}{'avg_us':>10}{'p50_us':>10}{'p99_us':>10}{'max_us':>10}"]
+        with self.lock:
+            for name, (count, total, peak, buckets) in self.stats.items():
+                if not count:
+                    continue
+                peak_us = peak * 1000000
+                lines.append(f"{name:<24}{count:>10}{total / count * 1000000:>10.1f}"
+                             f"{percentile(buckets, count, 0.5, peak_us):>10.1f}"
+                             f"{percentile(buckets, count, 0.99, peak_us):>10.1f}"
+                             f"{peak_us:>10.1f}")
+        return '\n'.join(lines)
+
+class MulticastPublisher:
+    """Fan-out broadcast qua UDP multicast (LAN): mỗi frame chỉ gửi 1 lần.
+
+    Datagram: epoch (4) | seq (8) | flags (1) | frame ChatProtocol nguyên vẹn.
+    Frame được giữ trong ring buffer theo seq; client thấy thiếu seq thì gửi
+    MCAST_NACK qua TCP và nhận lại MCAST_REPAIR. Frame lớn hơn MAX_DATAGRAM
+    chỉ gửi header FETCH, client lấy nội dung qua NACK. Khi không có traffic,
+    heartbeat mang seq mới nhất để client phát hiện mất gói ở cuối.
+    """
+    HEADER = struct.Struct('!IQB')
+    FRAME, FETCH, HEARTBEAT = 0, 1, 2
+    MAX_DATAGRAM = 8192  # Bytes, tránh phân mảnh IP quá nhiều trên LAN
+    RING_SIZE = 8192  # Số frame gần nhất giữ để sửa lỗi
+    HEARTBEAT_INTERVAL = 1.0
+    
+    def __init__(self, group, port, interface='0.0.0.0', ttl=1):
+        self.group = group
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface != '0.0.0.0':
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.epoch = random.getrandbits(32)  # Đổi khi server khởi động lại
+        self.seq = 0
+        self.ring = deque(maxlen=self.RING_SIZE)  # ring[-1] là frame của self.seq
+        self.lock = threading.Lock()
+        self.last_send = time.monotonic()
+        thread = threading.Thread(target=self.heartbeat_loop, name='multicast_heartbeat')
+        thread.daemon = True
+        thread.start()
+    
+    def info(self):
+        """Thông tin gửi cho client trong LOGIN_RESPONSE (seq: frame cuối đã phát)"""
+        return {"group": self.group, "port": self.port, "epoch": self.epoch, "seq": self.seq}
+    
+    def resume(self, epoch, seq):
+        """Tiếp tục epoch/seq của process cũ sau hot restart"""
+        with self.lock:
+            self.epoch = epoch
+            self.seq = seq
+            self.ring.clear()
+    
+    def send(self, seq, flags, frame=b''):
+        try:
+            self.sock.sendto(self.HEADER.pack(self.epoch, seq, flags) + frame, (self.group, self.port))
+        except OSError:
+            pass  # Client sẽ NACK
+        self.last_send = time.monotonic()
+    
+    def publish(self, frame):
+        with self.lock:
+            self.seq += 1
+            self.ring.append(frame)
+            if len(frame) <= self.MAX_DATAGRAM:
+                self.send(self.seq, self.FRAME, frame)
+            else:
+                self.send(self.seq, self.FETCH)
+    
+    def get(self, seq):
+        """Frame của seq, None nếu đã ra khỏi ring buffer"""
+        with self.lock:
+            index = seq - (self.seq - len(self.ring) + 1)
+            if 0 <= index < len(self.ring):
+                return self.ring[index]
+            return None
+    
+    def heartbeat_loop(self):
+        while True:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            with self.lock:
+                if time.monotonic() - self.last_send >= self.HEARTBEAT_INTERVAL:
+                    self.send(self.seq, self.HEARTBEAT)
+
+FilterResult = namedtuple('FilterResult', ['action', 'message', 'terms'])
+
+class AhoCorasick:
+    """Automaton Aho-Corasick (không phân biệt hoa thường) cho nhiều term cùng lúc.
+
+    Quét 1 lượt qua text: thời gian tuyến tính theo độ dài text (+ số match),
+    không phụ thuộc số term. Dựng xong thì không sửa nữa nên dùng chung giữa
+    các thread mà không cần lock.
+    """
+    def __init__(self, terms):
+        """terms: {term: action}"""
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]  # (độ dài, term, action) của term kết thúc tại node
+        self.dict_link = [0]  # Node gần nhất theo fail link có output (0 = không có)
+        for term, action in terms.items():
+            node = 0
+            for ch in term:
+                next_node = self.goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][ch] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.dict_link.append(0)
+                node = next_node
+            self.output[node] = (len(term), term, action)
+        
+        # BFS dựng fail link và dictionary link
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self.goto[node].items():
+                pending.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                target = self.goto[state].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                fallback = self.fail[child]
+                self.dict_link[child] = fallback if self.output[fallback] else self.dict_link[fallback]
+        # Node đầu tiên cần báo match khi tới node này (0 = không có) => 1 lần tra mỗi ký tự
+        self.report = [node if self.output[node] else self.dict_link[node] for node in range(len(self.goto))]
+        self.size = len(self.goto)
+    
+    def find(self, text):
+        """Trả về [(start, end, term, action)] của mọi term xuất hiện trong text"""
+        goto, fail, output, dict_link, report = self.goto, self.fail, self.output, self.dict_link, self.report
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            row = goto[state]
+            if ch in row:
+                state = row[ch]
+            elif state:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+            else:
+                continue
+            node = report[state]
+            while node:
+                length, term, action = output[node]
+                matches.append((i + 1 - length, i + 1, term, action))
+                node = dict_link[node]
+        return matches
+
+class ContentFilter:
+    """Bộ lọc tin nhắn vào theo danh sách term, tự nạp lại khi file thay đổi.
+
+    File term: mỗi dòng 1 term, tùy chọn kèm action sau dấu tab
+    (`term<TAB>reject|mask|tag`); dòng trống và dòng bắt đầu bằng # bị bỏ qua.
+    Nhiều term khớp thì lấy action nặng nhất: reject > mask > tag.
+    - reject: không broadcast, trả ERROR 403 cho người gửi
+    - mask: thay term bằng '*'
+    - tag: broadcast nguyên văn kèm "flagged": true
+    """
+    ACTIONS = ('tag', 'mask', 'reject')  # Theo thứ tự tăng dần
+    RELOAD_INTERVAL = 2.0  # Giây giữa 2 lần kiểm tra mtime của file
+    
+    def __init__(self, path, default_action='mask', whole_words=True, watch=True):
+        if default_action not in self.ACTIONS:
+            raise ValueError(f"Action không hợp lệ: {default_action}")
+        self.path = path
+        self.default_action = default_action
+        self.whole_words = whole_words  # Không khớp term nằm giữa 1 từ dài hơn
+        self.automaton = AhoCorasick({})
+        self.mtime = None
+        self.stats = {"checked": 0, "reject": 0, "mask": 0, "tag": 0}
+        self.reload()
+        if watch:
+            thread = threading.Thread(target=self.watch_loop, name='filter_reload')
+            thread.daemon = True
+            thread.start()
+    
+    def load_terms(self):
+        terms = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                term, _, action = line.partition('\t')
+                term = term.strip().lower()
+                action = action.strip() or self.default_action
+                if term and action in self.ACTIONS:
+                    terms[term] = action
+        return terms
+    
+    def reload(self):
+        """Dựng automaton mới rồi thay 1 lần (tin đang lọc vẫn dùng bản cũ)"""
+        mtime = os.path.getmtime(self.path)
+        start = time.perf_counter()
+        terms = self.load_terms()
+        self.automaton = AhoCorasick(terms)
+        self.mtime = mtime
+        print(f"[SERVER] Đã nạp {len(terms)} term lọc ({self.automaton.size} node, "
+              f"{(time.perf_counter() - start) * 1000:.0f}ms)")
+        return len(terms)
+    
+    def watch_loop(self):
+        while True:
+            time.sleep(self.RELOAD_INTERVAL)
+            try:
+                if os.path.getmtime(self.path) != self.mtime:
+                    self.reload()
+            except Exception as e:
+                print(f"[SERVER] Lỗi nạp lại term lọc: {e}")
+    
+    @staticmethod
+    def lower(text):
+        """lower() giữ nguyên độ dài để vị trí match dùng được cho text gốc"""
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            return lowered
+        return ''.join(ch if len(ch.lower()) != 1 else ch.lower() for ch in text)
+    
+    def check(self, message):
+        """Trả về FilterResult(action hoặc None, message sau khi lọc, các term khớp)"""
+        self.stats["checked"] += 1
+        if not isinstance(message, str):
+            return FilterResult(None, message, [])
+        matches = self.automaton.find(self.lower(message))
+        if self.whole_words and matches:
+            end = len(message)
+            matches = [m for m in matches
+                       if (m[0] == 0 or not message[m[0] - 1].isalnum())
+                       and (m[1] == end or not message[m[1]].isalnum())]
+        if not matches:
+            return FilterResult(None, message, [])
+        
+        action = max((m[3] for m in matches), key=self.ACTIONS.index)
+        terms = sorted({m[2] for m in matches})
+        self.stats[action] += 1
+        if action == 'mask':
+            chars = list(message)
+            for start, end, _, term_action in matches:
+                if term_action != 'tag':
+                    chars[start:end] = '*' * (end - start)
+            message = ''.join(chars)
+        return FilterResult(action, message, terms)
+
+class DedupWindow:
+    """Cửa sổ ID tin nhắn gần đây của 1 session (chế độ at-least-once).
+
+    Client gửi lại tin chưa được ACK sau khi reconnect; ID đã có trong cửa sổ
+    thì chỉ ACK lại, không broadcast lần nữa.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+    
+    def __contains__(self, msg_id):
+        return msg_id in self.ids
+    
+    def add(self, msg_id):
+        """True nếu msg_id mới, False nếu là bản gửi lại"""
+        if msg_id in self.ids:
+            return False
+        self.ids.add(msg_id)
+        self.order.append(msg_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+class MemoryBudget:
+    """Ngân sách bytes chung cho buffer nhận, hàng đợi gửi, kết nối và lịch sử chat.
+
+    Nơi giữ dữ liệu gọi charge(kind, ±bytes). Mức áp lực tính theo tổng so với
+    limit, ChatServer phản ứng tăng dần theo mức. Pause và shed chỉ xét dữ liệu
+    (tổng trừ chi phí cố định của kết nối) vì ngừng đọc hay bỏ stream không làm
+    kết nối nhàn rỗi tốn ít hơn; reject và evict xét cả tổng:
+    - pause (70%): reader ngừng đọc socket, TCP window đẩy ngược về phía client gửi
+    - shed (80%): hủy các stream STREAM_CHUNK đang chờ gửi, không nhận stream mới
+    - reject (90%): từ chối login mới bằng ERROR 503
+    - evict (100%): ngắt kết nối các client giữ nhiều bytes nhất trước
+    """
+    NORMAL, PAUSE, SHED, REJECT, EVICT = range(5)
+    LEVEL_NAMES = ('normal', 'pause', 'shed', 'reject', 'evict')
+    THRESHOLDS = (0.70, 0.80, 0.90, 1.00)
+    KINDS = ('inbound', 'outbound', 'connections', 'history')
+    CONNECTION_COST = 64 * 1024  # Bytes ước lượng cho 1 kết nối (stack 2 thread + buffer socket)
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.bounds = [int(limit * threshold) for threshold in self.THRESHOLDS]
+        self.usage = dict.fromkeys(self.KINDS, 0)
+        self.total = 0
+        self.peak = 0
+        self.counters = {"pauses": 0, "shed_streams": 0, "rejected_logins": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        # Set = được đọc socket; xóa khi vượt ngưỡng pause và còn dữ liệu chờ xử lý/gửi
+        self.readable = threading.Event()
+        self.readable.set()
+    
+    def charge(self, kind, nbytes):
+        with self.lock:
+            self.usage[kind] += nbytes
+            self.total += nbytes
+            if self.total > self.peak:
+                self.peak = self.total
+            # Chi phí cố định (kết nối, lịch sử) không giảm khi ngừng đọc => chỉ pause khi
+            # còn dữ liệu đang chờ, nếu không reader sẽ chờ mãi
+            paused = (self.total - self.usage['connections'] >= self.bounds[0]
+                      and self.usage['inbound'] + self.usage['outbound'] > 0)
+            if paused == self.readable.is_set():
+                if paused:
+                    self.readable.clear()
+                    self.counters["pauses"] += 1
+                else:
+                    self.readable.set()
+    
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+    
+    def level(self):
+        level = bisect_right(self.bounds, self.total - self.usage['connections'])
+        if self.total >= self.bounds[self.REJECT - 1]:
+            level = max(level, bisect_right(self.bounds, self.total))
+        return level
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "used": self.total,
+                "percent": round(self.total / self.limit * 100, 1),
+                "peak": self.peak,
+                "level": self.LEVEL_NAMES[self.level()],
+                "reading": self.readable.is_set(),
+                "usage": dict(self.usage),
+                "counters": dict(self.counters)
+            }
+
+class ChatHistory:
+    """Lịch sử chat gần đây trong RAM kèm inverted index để tìm kiếm.
+
+    Mỗi tin có seq tăng dần; index là {token: array('Q') các seq chứa token}.
+    Seq chỉ được thêm vào cuối nên posting list luôn sắp xếp sẵn, giao nhau
+    bằng bisect. Người gửi cũng là 1 token ("@nickname") để lọc theo nickname.
+    Giữ tối đa `limit` tin: vượt quá thì bỏ 1 lô tin cũ nhất và cắt phần đầu
+    các posting list của chúng, nên index không lớn hơn lịch sử còn giữ.
+    """
+    TOKEN = re.compile(r'\w+')
+    MAX_TOKEN = 32  # Ký tự, token dài hơn bị cắt
+    MAX_RESULTS = 50  # Số kết quả tối đa mỗi trang
+    ENTRY_COST = 120  # Bytes ước lượng cho tuple + object của 1 tin, chưa tính nội dung
+    
+    def __init__(self, limit=100000, budget=None):
+        self.limit = limit
+        # Có MemoryBudget thì lịch sử dùng tối đa 1/4 ngân sách, phần còn lại cho kết nối
+        self.budget = budget
+        self.max_bytes = budget.limit // 4 if budget is not None else None
+        self.bytes = 0
+        self.trim_batch = max(1, limit // 16)  # Cắt theo lô để không phải sửa index mỗi tin
+        self.messages = []  # [(seq, nickname, message, timestamp)] theo seq tăng dần
+        self.first_seq = 0  # seq của messages[0]
+        self.next_seq = 0
+        self.index = {}  # {token: array('Q') seq}
+        self.lock = threading.Lock()
+    
+    def tokenize(self, text):
+        return {token[:self.MAX_TOKEN] for token in self.TOKEN.findall(text.lower())}
+    
+    def message_tokens(self, nickname, message):
+        tokens = self.tokenize(message) if isinstance(message, str) else set()
+        tokens.add('@' + str(nickname).lower())
+        return tokens
+    
+    def entry_size(self, nickname, message, tokens):
+        """Bytes ước lượng của 1 tin cùng các posting của nó"""
+        text = message if isinstance(message, str) else str(message)
+        return self.ENTRY_COST + len(str(nickname)) + len(text) + 8 * len(tokens)
+    
+    def add(self, nickname, message, timestamp):
+        """Lưu 1 tin đã broadcast và cập nhật index, trả về seq"""
+        tokens = self.message_tokens(nickname, message)
+        size = self.entry_size(nickname, message, tokens)
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.messages.append((seq, nickname, message, timestamp))
+            for token in tokens:
+                postings = self.index.get(token)
+                if postings is None:
+                    postings = self.index[token] = array('Q')
+                postings.append(seq)
+            self.bytes += size
+            if self.budget is not None:
+                self.budget.charge('history', size)
+            if len(self.messages) > self.limit:
+                self.trim(self.trim_batch)
+            elif self.max_bytes is not None and self.bytes > self.max_bytes:
+                self.trim(min(len(self.messages), max(1, len(self.messages) // 16)))
+        return seq
+    
+    def trim(self, count):
+        """Bỏ count tin cũ nhất cùng các seq của chúng trong index (giữ lock)"""
+        dropped = self.messages[:count]
+        del self.messages[:count]
+        self.first_seq = dropped[-1][0] + 1
+        tokens = set()
+        freed = 0
+        for _, nickname, message, _ in dropped:
+            message_tokens = self.message_tokens(nickname, message)
+            freed += self.entry_size(nickname, message, message_tokens)
+            tokens |= message_tokens
+        self.bytes -= freed
+        if self.budget is not None:
+            self.budget.charge('history', -freed)
+        for token in tokens:
+            postings = self.index.get(token)
+            if postings is None:
+                continue
+            cut = bisect_left(postings, self.first_seq)
+            if cut == len(postings):
+                del self.index[token]
+            else:
+                del postings[:cut]
+    
+    def search(self, query, nickname=None, since=None, until=None, before=None, limit=20):
+        """Tin chứa mọi token của query (và của nickname nếu có), mới nhất trước.
+
+        before: con trỏ trang, chỉ lấy tin có seq < before.
+        Trả về (hits, next): next là giá trị before cho trang sau, None nếu hết.
+        """
+        tokens = self.tokenize(query) if query else set()
+        if nickname:
+            tokens.add('@' + nickname.lower())
+        if not tokens:
+            return [], None
+        limit = max(1, min(limit, self.MAX_RESULTS))
+        
+        hits = []
+        with self.lock:
+            lists = []
+            for token in tokens:
+                postings = self.index.get(token)
+                if postings is None:
+                    return [], None
+                lists.append(postings)
+            # Duyệt list ngắn nhất, các list còn lại chỉ kiểm tra bằng bisect
+            lists.sort(key=len)
+            shortest, others = lists[0], lists[1:]
+            end = len(shortest) if before is None else bisect_left(shortest, before)
+            for i in range(end - 1, -1, -1):
+                seq = shortest[i]
+                if not all(self.contains(postings, seq) for postings in others):
+                    continue
+                _, sender, message, timestamp = self.messages[seq - self.first_seq]
+                if until is not None and timestamp > until:
+                    continue
+                if since is not None and timestamp < since:
+                    break  # Timestamp tăng theo seq => các tin cũ hơn đều ngoài khoảng
+                if len(hits) == limit:
+                    return hits, hits[-1]["seq"]
+                hits.append({"seq": seq, "nickname": sender, "message": message, "timestamp": timestamp})
+        return hits, None
+    
+    @staticmethod
+    def contains(postings, seq):
+        i = bisect_left(postings, seq)
+        return i < len(postings) and postings[i] == seq
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "messages": len(self.messages),
+                "bytes": self.bytes,
+                "tokens": len(self.index),
+                "postings": sum(len(postings) for postings in self.index.values())
+            }
+
+class Outbox:
+    """Hàng đợi gửi của 1 client, do 1 thread writer riêng ghi ra socket.
+
+    broadcast()/send_to_client() chỉ enqueue frame đã encode nên 1 client chậm
+    không chặn các client khác. Writer gộp các frame đang chờ vào 1 lần
+    sendall(). close() gửi nốt các frame còn lại rồi mới đóng socket.
+
+    Frame được chia 3 lane theo loại message: control (PONG, ERROR, roster,
+    ACK...) gửi trước, rồi chat, rồi bulk (STREAM_CHUNK). Mỗi lần ghi lấy hết
+    control + chat nhưng chỉ 1 chunk bulk (khi không có chat thì tối đa
+    BULK_BATCH bytes), luân phiên giữa các stream, nên payload lớn không chặn
+    chat và stream nhỏ không phải chờ stream lớn gửi xong.
+    """
+    CONTROL, CHAT, BULK = 0, 1, 2
+    LANES = {
+        ChatProtocol.LOGIN_RESPONSE: CONTROL,
+        ChatProtocol.USER_JOIN: CONTROL,
+        ChatProtocol.USER_LEAVE: CONTROL,
+        ChatProtocol.USER_LIST: CONTROL,
+        ChatProtocol.PONG: CONTROL,
+        ChatProtocol.ERROR: CONTROL,
+        ChatProtocol.SERVER_SHUTDOWN: CONTROL,
+        ChatProtocol.SEND_ACK: CONTROL,
+        ChatProtocol.PRESENCE: CONTROL,
+        ChatProtocol.STREAM_CHUNK: BULK
+    }
+    BULK_BATCH = 64 * 1024  # Bytes bulk tối đa mỗi lần ghi khi không có chat chờ
+    
+    def __init__(self, server, client_socket):
+        self.server = server
+        self.client_socket = client_socket
+        self.control = deque()
+        self.chat = deque()
+        self.bulk = OrderedDict()  # {stream key: deque}, luân phiên giữa các stream
+        self.count = 0  # Tổng số frame đang chờ ở cả 3 lane
+        self.bytes = 0  # Tổng bytes các frame đang chờ (chưa lấy ra để gửi)
+        self.budget = server.budget
+        self.connection_charged = self.budget is not None
+        if self.connection_charged:
+            self.budget.charge('connections', MemoryBudget.CONNECTION_COST)
+        self.cond = threading.Condition()
+        self.sending = False
+        self.closing = False
+        self.detached = False
+        self.failed = False
+        self.thread = threading.Thread(target=self.writer_loop)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def __len__(self):
+        return self.count
+    
+    def put(self, frame, lane=None, stream=None):
+        """Enqueue frame; lane mặc định suy ra từ msg type trong header"""
+        if lane is None:
+            lane = self.LANES.get(frame[4], self.CHAT) if len(frame) >= 9 else self.CHAT
+        with self.cond:
+            if self.closing or self.failed:
+                return False
+            if lane == self.CONTROL:
+                self.control.append(frame)
+            elif lane == self.BULK:
+                frames = self.bulk.get(stream)
+                if frames is None:
+                    frames = self.bulk[stream] = deque()
+                frames.append(frame)
+            else:
+                self.chat.append(frame)
+            self.count += 1
+            self.bytes += len(frame)
+            self.cond.notify_all()
+        if self.budget is not None:
+            self.budget.charge('outbound', len(frame))
+        return True
+    
+    def uncharge(self, nbytes, connection=False):
+        """Trả lại budget bytes đã gửi/bỏ (connection=True: cả chi phí kết nối)"""
+        if self.budget is not None:
+            if nbytes:
+                self.budget.charge('outbound', -nbytes)
+            if connection and self.connection_charged:
+                self.connection_charged = False  # detach() có thể được gọi 2 lần
+                self.budget.charge('connections', -MemoryBudget.CONNECTION_COST)
+    
+    def shed_bulk(self):
+        """Bỏ mọi chunk bulk đang chờ; trả về các stream key bị bỏ"""
+        with self.cond:
+            streams = list(self.bulk)
+            dropped = [frame for frames in self.bulk.values() for frame in frames]
+            self.bulk.clear()
+            freed = sum(len(frame) for frame in dropped)
+            self.count -= len(dropped)
+            self.bytes -= freed
+        self.uncharge(freed)
+        return streams
+    
+    def discard(self):
+        """Bỏ mọi frame đang chờ (khi ngắt client để giải phóng bộ nhớ)"""
+        with self.cond:
+            freed = self.bytes
+            self.control.clear()
+            self.chat.clear()
+            self.bulk.clear()
+            self.count = 0
+            self.bytes = 0
+        self.uncharge(freed)
+        return freed
+    
+    def take_bulk(self, limit):
+        """Lấy chunk bulk luân phiên giữa các stream, tối đa limit bytes (ít nhất 1 chunk)"""
+        taken = []
+        size = 0
+        while self.bulk and (not taken or size < limit):
+            stream, frames = next(iter(self.bulk.items()))
+            frame = frames.popleft()
+            taken.append(frame)
+            size += len(frame)
+            if frames:
+                self.bulk.move_to_end(stream)
+            else:
+                del self.bulk[stream]
+        return taken
+    
+    def take_batch(self):
+        """Gom 1 lần ghi theo thứ tự ưu tiên control > chat > bulk"""
+        batch = list(self.control)
+        self.control.clear()
+        if self.chat:
+            batch.extend(self.chat)
+            self.chat.clear()
+            batch.extend(self.take_bulk(0))  # 1 chunk để bulk không bị đói
+        else:
+            batch.extend(self.take_bulk(self.BULK_BATCH))
+        self.count -= len(batch)
+        data = b''.join(batch)
+        self.bytes -= len(data)
+        return data
+    
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                while not self.count and not self.closing and not self.detached:
+                    self.cond.wait()
+                if self.detached:
+                    return  # Socket được bàn giao, không đóng
+                if not self.count:
+                    break  # closing và đã gửi hết
+                batch = self.take_batch()
+                self.sending = True
+            try:
+                self.client_socket.sendall(batch)
+            except Exception:
+                self.failed = True
+            self.uncharge(len(batch))
+            with self.cond:
+                self.sending = False
+                self.cond.notify_all()
+            if self.failed:
+                break
+        
+        # Frame còn lại (khi gửi lỗi) bị bỏ cùng Outbox
+        with self.cond:
+            freed, self.bytes = self.bytes, 0
+        self.uncharge(freed, connection=True)
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)  # Đánh thức thread reader
+        except:
+            pass
+        try:
+            self.client_socket.close()
+        except:
+            pass
+        if self.failed:
+            self.server.remove_client(self.client_socket)
+    
+    def flush(self, timeout):
+        """Chờ hàng đợi gửi hết; True nếu gửi hết trong timeout"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while (self.count or self.sending) and not self.failed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return not self.failed
+    
+    def close(self):
+        """Gửi nốt các frame còn lại rồi đóng socket (không chờ)"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+    
+    def detach(self, timeout):
+        """Dừng writer mà không đóng socket (hot restart).
+
+        Trả về các bytes chưa gửi, hoặc None nếu writer vẫn kẹt trong sendall().
+        """
+        with self.cond:
+            self.detached = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            return None
+        with self.cond:
+            pending = []
+            while self.count:
+                pending.append(self.take_batch())
+        pending = b''.join(pending)
+        self.uncharge(len(pending), connection=True)
+        return pending
+
 class ChatServer:
-    def __init__(self, host='localhost', port=12345):
+    DEFAULT_ROOM = "main"  # Hiện tại mọi client TCP đều ở chung 1 room
+    
+    LOGIN_TIMEOUT = 10  # Giây, từ lúc accept tới khi nhận đủ LOGIN_REQUEST (gồm TLS handshake)
+    PRELOGIN_LIMIT = 64 * 1024  # Bytes nhận trước khi có LOGIN_REQUEST; vượt quá => giao worker xử lý/từ chối
+    HANDOFF_BATCH = 200  # Số fd mỗi lần sendmsg (giới hạn SCM_RIGHTS là 253)
+    PRESENCE_TICK = 0.05  # Giây, cửa sổ gom USER_JOIN/USER_LEAVE/USER_LIST
+    LEAVE_GRACE = 3.0  # Giây chờ trước khi báo rời đi; reconnect trong khoảng này thì không báo
+    PRESENCE_MODES = ('legacy', 'batched', 'none')
+    SESSION_LIMIT = 10000  # Số session at-least-once giữ DedupWindow (LRU)
+    MAX_FRAME = 1 << 20  # Bytes, frame lớn hơn phải gửi bằng STREAM_CHUNK
+    CHUNK_LIMIT = 64 * 1024  # Ký tự data tối đa trong 1 STREAM_CHUNK
+    MAX_STREAMS = 8  # Số stream đang mở tối đa của 1 client
+    NACK_LIMIT = 1024  # Số seq tối đa được sửa trong 1 MCAST_NACK
+    BUDGET_TICK = 0.1  # Giây giữa 2 lần kiểm tra ngân sách bộ nhớ
+    STALL_TIMEOUT = 5.0  # Giây pause liên tục mà không giảm được => ngắt client lớn nhất
+    MAX_PROFILE = 300  # Giây tối đa của 1 lệnh profile (giữ profile_lock suốt thời gian đó)
+    MIN_PROFILE_INTERVAL = 0.001  # Giây, chu kỳ lấy mẫu nhỏ nhất
+    
+    def __init__(self, host='localhost', port=12345, ssl_context=None,
+                 backlog=1024, login_workers=16, admission_queue=1024, capture_path=None,
+                 multicast=None, history_limit=100000, memory_budget=None):
         self.host = host
         self.port = port
+        self.ssl_context = ssl_context  # None => TCP thường
+        # MulticastPublisher: broadcast tới client bật multicast chỉ gửi 1 lần qua UDP
+        self.multicast = multicast
+        # Ghi trace các frame nhận được để replay khi đo hiệu năng
+        self.capture = TraceWriter(capture_path) if capture_path else None
+        # Ngân sách bytes cho buffer nhận, Outbox và lịch sử (None => không giới hạn)
+        self.budget = MemoryBudget(memory_budget) if memory_budget else None
+        self.inbound_sizes = {}  # {client_socket: bytes buffer nhận dở}
+        self.backlog = backlog  # Hàng đợi SYN/accept của kernel khi login storm
+        self.login_workers = login_workers
+        # Kết nối đã accept chờ login worker; đầy thì ngừng accept (kernel backlog giữ hộ)
+        self.admission = queue.Queue(maxsize=admission_queue)
+        self.prelogin = 0  # Kết nối đang handshake/chờ LOGIN_REQUEST trong accept_loop
         self.clients = {}  # {client_socket: user_info}
         self.nicknames = set()  # Set of active nicknames
-        self.lock = threading.Lock()
+        self.outboxes = {}  # {client_socket: Outbox}, cả client chưa đăng nhập
+        self.sessions = OrderedDict()  # {session token: DedupWindow}, giữ qua reconnect
+        # RLock vì remove_client() gọi lại broadcast() khi đang giữ lock
+        self.lock = threading.RLock()
+        self.subscriptions = ()  # Copy-on-write, fan-out đọc không cần lock
+        self.subscriptions_lock = threading.Lock()
+        
+        self.listen_socket = None
+        self.accepting = False
+        self.accept_done = threading.Event()
+        self.stopped = threading.Event()
+        self.shutting_down = False
+        
+        # Hot restart: pipe đánh thức mọi thread reader để dừng đọc socket
+        self.handing_off = False
+        self.handoff_buffers = {}  # {client_socket: buffer nhận dở}
+        self.wake_r, self.wake_w = os.pipe()
+        self.readers = 0
+        self.readers_cond = threading.Condition()
+        
+        # Login trong cùng 1 tick => 1 USER_JOIN gộp + 1 USER_LIST
+        self.pending_joins = []  # [(client_socket, nickname)]
+        self.pending_leaves = {}  # {nickname: thời điểm hết grace}, vẫn tính là có mặt
+        self.present = set()  # Nickname đã báo tham gia và chưa báo rời đi
+        self.presence_cond = threading.Condition()
+        
+        # Các bộ lọc tin nhắn vào, chạy theo thứ tự trước khi broadcast (xem add_filter)
+        self.inbound_filters = []
         
-    def broadcast(self, msg_type, data, exclude_client=None):
-        """Broadcast message tới tất cả clients"""
+        # Tin chat gần đây để tìm kiếm (SEARCH_REQUEST); history_limit=0 => tắt
+        self.history = ChatHistory(history_limit, self.budget) if history_limit else None
+        
+        # Profiling lúc runtime qua control socket (xem serve_control)
+        self.timer = HandlerTimer(self)
+        self.profile_lock = threading.Lock()  # Mỗi lúc chỉ 1 phiên profile
+        self.started_at = time.time()
+        
+    def broadcast(self, msg_type, data, exclude_client=None, room=DEFAULT_ROOM, stream=None,
+                  presence=None):
+        """Broadcast message tới tất cả clients (exclude_client: 1 socket hoặc set).
+
+        stream: khóa stream của STREAM_CHUNK để Outbox luân phiên giữa các stream.
+        presence: chỉ gửi tới client chọn kiểu presence này ('legacy'/'batched').
+        """
         message = ChatProtocol.pack_message(msg_type, data)
+        if isinstance(exclude_client, (set, frozenset)):
+            excluded = exclude_client
+        else:
+            excluded = (exclude_client,)
         
         with self.lock:
-            disconnected_clients = []
-            for client_socket in self.clients:
-                if client_socket != exclude_client:
-                    try:
-                        client_socket.send(message)
-                    except:
-                        disconnected_clients.append(client_socket)
-            
-            # Clean up disconnected clients
-            for client in disconnected_clients:
-                self.remove_client(client)
+            # Publish trong lock để seq khớp với lúc client chuyển sang multicast
+            if self.multicast is not None and room == self.DEFAULT_ROOM:
+                self.multicast.publish(message)
+            for client_socket, user_info in self.clients.items():
+                if presence is not None and user_info.get('presence', 'legacy') != presence:
+                    continue
+                if client_socket not in excluded and not user_info.get('multicast'):
+                    outbox = self.outboxes.get(client_socket)
+                    if outbox is not None:
+                        outbox.put(message, stream=stream)
+        
+        # Subscriber nội bộ nhận object đã decode, không qua socket
+        self.publish_local(room, msg_type, data)
+    
+    def add_filter(self, content_filter):
+        """Thêm 1 bộ lọc CHAT_MESSAGE: object có check(message) -> FilterResult"""
+        self.inbound_filters = self.inbound_filters + [content_filter]  # Copy-on-write
+    
+    def subscribe(self, filter=None, callback=None, maxsize=1000):
+        """Đăng ký nhận event của server trong cùng tiến trình (xem Subscription)"""
+        subscription = Subscription(self, filter, callback, maxsize)
+        with self.subscriptions_lock:
+            self.subscriptions = self.subscriptions + (subscription,)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self.subscriptions_lock:
+            self.subscriptions = tuple(s for s in self.subscriptions if s is not subscription)
+    
+    def publish_local(self, room, msg_type, data):
+        """Chuyển event tới các subscriber nội bộ"""
+        subscriptions = self.subscriptions
+        if not subscriptions:
+            return
+        event = ServerEvent(room, msg_type, data)
+        for subscription in subscriptions:
+            try:
+                if subscription.matches(event):
+                    subscription.deliver(event)
+            except Exception as e:
+                # Lỗi của subscriber (vd filter raise) không được lan vào broadcast()
+                # của reader/presence thread => hủy đăng ký subscription đó
+                print(f"[SERVER] Lỗi trong subscriber filter, hủy đăng ký: {e}")
+                subscription.close()
+    
+    def publish(self, room, payload, nickname="[server]"):
+        """Đưa 1 thông báo vào room từ service khác trong tiến trình.
+
+        payload là string (nội dung tin) hoặc dict (ghép vào CHAT_MESSAGE).
+        Room mặc định được broadcast tới client TCP (encode 1 lần cho mọi
+        client); room khác chỉ tới subscriber nội bộ.
+        """
+        chat_data = {
+            "nickname": nickname,
+            "message": "" if isinstance(payload, dict) else payload,
+            "timestamp": time.time()
+        }
+        if isinstance(payload, dict):
+            chat_data.update(payload)
+        if room != self.DEFAULT_ROOM:
+            chat_data["room"] = room
+            self.publish_local(room, ChatProtocol.CHAT_MESSAGE, chat_data)
+        else:
+            self.broadcast(ChatProtocol.CHAT_MESSAGE, chat_data)
     
     def send_to_client(self, client_socket, msg_type, data):
         """Gửi message tới 1 client cụ thể"""
-        try:
-            message = ChatProtocol.pack_message(msg_type, data)
-            client_socket.send(message)
-            return True
-        except:
-            self.remove_client(client_socket)
+        outbox = self.outboxes.get(client_socket)
+        if outbox is None:
             return False
+        return outbox.put(ChatProtocol.pack_message(msg_type, data))
     
     def remove_client(self, client_socket):
         """Xóa client khỏi server"""
+        if self.capture:
+            self.capture.record(TraceWriter.CLOSE, client_socket)
         with self.lock:
             if client_socket in self.clients:
                 user_info = self.clients[client_socket]
@@ -123,37 +1262,63 @@ class ChatServer:
                 del self.clients[client_socket]
                 self.nicknames.discard(nickname)
                 
-                # Broadcast user leave
-                leave_data = {
-                    "nickname": nickname,
-                    "message": f"{nickname} đã rời khỏi chat room",
-                    "timestamp": time.time()
-                }
-                self.broadcast(ChatProtocol.USER_LEAVE, leave_data, client_socket)
-                
-                # Send updated user list
-                self.broadcast_user_list()
+                # Khi tắt server không broadcast từng người rời đi (O(N²) frame)
+                if not self.shutting_down:
+                    # Báo các stream đang gửi dở bị hủy để client bỏ phần đã nhận
+                    for stream_id in user_info.get('streams', {}):
+                        self.broadcast(ChatProtocol.STREAM_CHUNK, {
+                            "nickname": nickname,
+                            "stream_id": stream_id,
+                            "final": True,
+                            "aborted": True,
+                            "timestamp": time.time()
+                        }, client_socket, stream=(nickname, stream_id))
+                    
+                    # Chưa báo rời đi ngay: reconnect trong LEAVE_GRACE thì hủy (xem flush_presence)
+                    with self.presence_cond:
+                        self.pending_leaves[nickname] = time.monotonic() + self.LEAVE_GRACE
+                        self.presence_cond.notify()
                 
                 print(f"[SERVER] {nickname} đã ngắt kết nối")
-                
-        try:
-            client_socket.close()
-        except:
-            pass
+            
+            outbox = self.outboxes.pop(client_socket, None)
+        
+        if outbox is not None:
+            outbox.close()  # Gửi nốt frame đang chờ (vd ERROR) rồi đóng socket
+        else:
+            try:
+                client_socket.close()
+            except:
+                pass
     
-    def broadcast_user_list(self):
-        """Broadcast danh sách users hiện tại"""
+    def session_window(self, token):
+        """DedupWindow của session (tạo mới nếu chưa có, bỏ session cũ nhất khi quá giới hạn)"""
         with self.lock:
-            user_list = [info['nickname'] for info in self.clients.values()]
-        
-        user_list_data = {
-            "users": user_list,
-            "count": len(user_list)
-        }
-        self.broadcast(ChatProtocol.USER_LIST, user_list_data)
+            window = self.sessions.get(token)
+            if window is None:
+                window = self.sessions[token] = DedupWindow()
+                if len(self.sessions) > self.SESSION_LIMIT:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(token)
+            return window
     
-    def handle_login_request(self, client_socket, nickname):
-        """Xử lý yêu cầu đăng nhập"""
+    def handle_login_request(self, client_socket, nickname, options=None):
+        """Xử lý yêu cầu đăng nhập.
+
+        options: dict từ LOGIN_REQUEST dạng JSON, vd {"session": token} để bật
+        dedup cho chế độ at-least-once.
+        """
+        if nickname is not None and not isinstance(nickname, str):
+            nickname = str(nickname)  # vd nickname "123" bị parse thành số
+        if self.budget is not None and self.budget.level() >= MemoryBudget.REJECT:
+            self.budget.count("rejected_logins")
+            self.send_to_client(client_socket, ChatProtocol.ERROR, {
+                "error_code": ChatProtocol.ERROR_SERVER_BUSY,
+                "error_message": "Server đang quá tải, vui lòng thử lại sau",
+                "timestamp": time.time()
+            })
+            return False
         with self.lock:
             if not nickname or len(nickname.strip()) == 0:
                 error_data = {
@@ -179,10 +1344,23 @@ class ChatServer:
             user_info = {
                 "nickname": nickname,
                 "joined_at": time.time(),
-                "address": client_socket.getpeername()
+                "address": client_socket.getpeername(),
+                "streams": {}  # {stream_id: seq chunk kế tiếp}
             }
+            presence = (options or {}).get('presence')
+            user_info['presence'] = presence if presence in self.PRESENCE_MODES else 'legacy'
+            session = (options or {}).get('session')
+            if session:
+                user_info['session'] = session
+                user_info['dedup'] = self.session_window(session)
             self.clients[client_socket] = user_info
             self.nicknames.add(nickname)
+            
+            # Từ seq này trở đi client nhận broadcast qua multicast thay vì TCP
+            multicast_info = None
+            if self.multicast is not None and (options or {}).get('multicast'):
+                user_info['multicast'] = True
+                multicast_info = self.multicast.info()
         
         # Send login response
         login_response = {
@@ -190,22 +1368,125 @@ class ChatServer:
             "message": f"Chào mừng {nickname}!",
             "timestamp": time.time()
         }
+        if multicast_info:
+            login_response["multicast"] = multicast_info
         self.send_to_client(client_socket, ChatProtocol.LOGIN_RESPONSE, login_response)
         
-        # Broadcast user join
-        join_data = {
-            "nickname": nickname,
-            "message": f"{nickname} đã tham gia chat room",
-            "timestamp": time.time()
-        }
-        self.broadcast(ChatProtocol.USER_JOIN, join_data, client_socket)
-        
-        # Send user list to all clients
-        self.broadcast_user_list()
+        # USER_JOIN và USER_LIST được gom theo tick (xem flush_presence);
+        # vào lại trong grace => hủy USER_LEAVE đang chờ, không báo tham gia
+        with self.presence_cond:
+            self.pending_leaves.pop(nickname, None)
+            self.pending_joins.append((client_socket, nickname))
+            self.presence_cond.notify()
         
         print(f"[SERVER] {nickname} đã tham gia chat room")
         return True
     
+    def presence_loop(self):
+        """Thread gom presence: chờ login/leave hết grace, đợi hết tick rồi flush 1 lần"""
+        while not self.stopped.is_set():
+            with self.presence_cond:
+                now = time.monotonic()
+                next_leave = min(self.pending_leaves.values(), default=now + 1.0)
+                if not self.pending_joins and next_leave > now:
+                    self.presence_cond.wait(min(next_leave - now, 1.0))
+                    continue
+            time.sleep(self.PRESENCE_TICK)
+            try:
+                self.flush_presence()
+            except Exception as e:
+                # 1 lần flush lỗi không được làm dừng hẳn thông báo join/leave
+                print(f"[SERVER] Lỗi gửi presence: {e}")
+    
+    @staticmethod
+    def format_names(nicknames, limit=10):
+        """'a, b, c' hoặc 'a, b, ... và N người khác' khi quá dài"""
+        if len(nicknames) <= limit:
+            return ", ".join(nicknames)
+        return f"{', '.join(nicknames[:limit])} và {len(nicknames) - limit} người khác"
+    
+    def flush_presence(self):
+        """Gom mọi thay đổi presence trong tick vừa qua.
+
+        Client 'legacy': 1 USER_JOIN gộp + 1 USER_LEAVE gộp + 1 USER_LIST.
+        Client 'batched': 1 PRESENCE {"joined", "left", "count"}; người mới vào
+        nhận thêm 1 PRESENCE có "users" (ảnh chụp danh sách) chỉ cho riêng họ.
+        Client 'none' không nhận gì.
+        """
+        now = time.monotonic()
+        with self.presence_cond:
+            joins, self.pending_joins = self.pending_joins, []
+            expired = [nickname for nickname, deadline in self.pending_leaves.items() if deadline <= now]
+            for nickname in expired:
+                del self.pending_leaves[nickname]
+            # Bỏ những người đã rời đi ngay trong tick; ai đã có mặt (vào lại trong grace) thì không báo lại
+            joins = [(client_socket, nickname) for client_socket, nickname in joins
+                     if client_socket in self.clients]
+            joined = []
+            for _, nickname in joins:
+                if nickname not in self.present:
+                    self.present.add(nickname)
+                    joined.append(nickname)
+            # Người hết grace nhưng tên đang được dùng lại (vd vừa đăng nhập) thì vẫn có mặt
+            left = [nickname for nickname in expired
+                    if nickname in self.present and nickname not in self.nicknames]
+            self.present.difference_update(left)
+            user_list = sorted(self.present)
+        if not joins and not left:
+            return
+        
+        joiners = {client_socket for client_socket, _ in joins}
+        timestamp = time.time()
+        
+        if joined:
+            names = self.format_names(joined)
+            self.broadcast(ChatProtocol.USER_JOIN, {
+                "nickname": names,
+                "nicknames": joined,
+                "count": len(joined),
+                "message": f"{names} đã tham gia chat room",
+                "timestamp": timestamp
+            }, joiners, presence='legacy')
+        if left:
+            names = self.format_names(left)
+            self.broadcast(ChatProtocol.USER_LEAVE, {
+                "nickname": names,
+                "nicknames": left,
+                "count": len(left),
+                "message": f"{names} đã rời khỏi chat room",
+                "timestamp": timestamp
+            }, presence='legacy')
+        user_list_data = {"users": user_list, "count": len(user_list)}
+        if joined or left:
+            self.broadcast(ChatProtocol.USER_LIST, user_list_data, presence='legacy')
+            self.broadcast(ChatProtocol.PRESENCE, {
+                "joined": joined,
+                "left": left,
+                "count": len(user_list),
+                "timestamp": timestamp
+            }, joiners, presence='batched')
+        snapshot = None
+        for client_socket, _ in joins:
+            user_info = self.clients.get(client_socket)
+            if user_info is None:
+                continue
+            if user_info.get('presence') == 'legacy' and not (joined or left):
+                # Chỉ có người vào lại trong grace: phòng không đổi, chỉ họ cần USER_LIST
+                self.send_to_client(client_socket, ChatProtocol.USER_LIST, user_list_data)
+            if user_info.get('presence') != 'batched':
+                continue
+            if snapshot is None:
+                snapshot = ChatProtocol.pack_message(ChatProtocol.PRESENCE, {
+                    "users": user_list,
+                    "joined": [],
+                    "left": [],
+                    "count": len(user_list),
+                    "timestamp": timestamp
+                })
+            outbox = self.outboxes.get(client_socket)
+            if outbox is not None:
+                outbox.put(snapshot)
+    
     def handle_chat_message(self, client_socket, message_data):
         """Xử lý tin nhắn chat"""
         if client_socket not in self.clients:
@@ -214,26 +1495,240 @@ class ChatServer:
         user_info = self.clients[client_socket]
         nickname = user_info['nickname']
         
+        # Client mới gửi {"id": ..., "message": ...}; client cũ gửi string
+        msg_id = None
+        if isinstance(message_data, dict):
+            msg_id = message_data.get('id')
+            message_data = message_data.get('message', '')
+        
+        window = user_info.get('dedup') if msg_id is not None else None
+        if window is not None and msg_id in window:
+            # Bản gửi lại của tin đã broadcast => chỉ ACK lại
+            self.send_to_client(client_socket, ChatProtocol.SEND_ACK, {"id": msg_id, "dup": True})
+            return
+        
+        flagged = False
+        for content_filter in self.inbound_filters:
+            result = content_filter.check(message_data)
+            if result.action == 'reject':
+                error_data = {
+                    "error_code": ChatProtocol.ERROR_FORBIDDEN,
+                    "error_message": "Tin nhắn chứa nội dung bị cấm",
+                    "timestamp": time.time()
+                }
+                if msg_id is not None:
+                    error_data["id"] = msg_id  # Để client bỏ tin khỏi hàng chờ ACK
+                self.send_to_client(client_socket, ChatProtocol.ERROR, error_data)
+                print(f"[FILTER] Chặn tin của {nickname} ({', '.join(result.terms)})")
+                return
+            if result.action == 'tag':
+                flagged = True
+                print(f"[FILTER] Gắn cờ tin của {nickname} ({', '.join(result.terms)})")
+            message_data = result.message
+        
         chat_data = {
             "nickname": nickname,
             "message": message_data,
             "timestamp": time.time()
         }
+        if flagged:
+            chat_data["flagged"] = True
+        # Chỉ ghi ID khi tin thật sự được broadcast: tin bị bộ lọc chặn mà gửi lại vẫn nhận 403
+        if window is not None and not window.add(msg_id):
+            self.send_to_client(client_socket, ChatProtocol.SEND_ACK, {"id": msg_id, "dup": True})
+            return
+        if self.history is not None:
+            self.history.add(nickname, message_data, chat_data["timestamp"])
         
-        # Broadcast tới tất cả clients (kể cả người gửi để confirm)
-        self.broadcast(ChatProtocol.CHAT_MESSAGE, chat_data)
+        if msg_id is None:
+            # Broadcast tới tất cả clients (kể cả người gửi để confirm)
+            self.broadcast(ChatProtocol.CHAT_MESSAGE, chat_data)
+        else:
+            # Người gửi chỉ nhận SEND_ACK nhỏ thay vì echo cả tin nhắn
+            self.broadcast(ChatProtocol.CHAT_MESSAGE, chat_data, client_socket)
+            self.send_to_client(client_socket, ChatProtocol.SEND_ACK, {"id": msg_id})
         print(f"[CHAT] {nickname}: {message_data}")
     
+    def handle_stream_chunk(self, client_socket, chunk):
+        """Chuyển tiếp 1 chunk của payload lớn ngay khi nhận, không gom cả payload.
+
+        chunk: {"stream_id", "seq" (0, 1, ...), "final", "data", "name" (tùy chọn,
+        ở chunk đầu)}. Chunk sai thứ tự hoặc quá lớn => ERROR và hủy stream.
+        """
+        if client_socket not in self.clients:
+            return
+        user_info = self.clients[client_socket]
+        nickname = user_info['nickname']
+        streams = user_info['streams']
+        
+        def reject(message, stream_id=None, error_code=ChatProtocol.ERROR_BAD_REQUEST):
+            with self.lock:
+                aborted = streams.pop(stream_id, None) is not None
+            if aborted:
+                self.broadcast(ChatProtocol.STREAM_CHUNK, {
+                    "nickname": nickname, "stream_id": stream_id, "final": True,
+                    "aborted": True, "timestamp": time.time()
+                }, client_socket, stream=(nickname, stream_id))
+            self.send_to_client(client_socket, ChatProtocol.ERROR, {
+                "error_code": error_code,
+                "error_message": message,
+                "timestamp": time.time()
+            })
+        
+        if not isinstance(chunk, dict) or chunk.get('stream_id') is None:
+            return reject("STREAM_CHUNK thiếu stream_id")
+        stream_id = str(chunk['stream_id'])
+        seq = chunk.get('seq')
+        data = chunk.get('data', '')
+        if not isinstance(data, str) or len(data) > self.CHUNK_LIMIT:
+            return reject(f"Chunk vượt quá {self.CHUNK_LIMIT} ký tự", stream_id)
+        if seq != streams.get(stream_id, 0):
+            return reject(f"Chunk {seq} của stream {stream_id} sai thứ tự", stream_id)
+        if seq == 0 and len(streams) >= self.MAX_STREAMS:
+            return reject(f"Tối đa {self.MAX_STREAMS} stream cùng lúc")
+        if seq == 0 and self.budget is not None and self.budget.level() >= MemoryBudget.SHED:
+            self.budget.count("shed_streams")
+            return reject("Server đang quá tải, tạm ngừng nhận stream", stream_id,
+                          ChatProtocol.ERROR_SERVER_BUSY)
+        
+        # Cùng bộ lọc với CHAT_MESSAGE, áp dụng cho từng chunk (term bị cắt ngang
+        # ranh giới 2 chunk thì không bắt được)
+        flagged = False
+        for content_filter in self.inbound_filters:
+            result = content_filter.check(data)
+            if result.action == 'reject':
+                print(f"[FILTER] Chặn stream {stream_id} của {nickname} ({', '.join(result.terms)})")
+                return reject("Stream chứa nội dung bị cấm", stream_id, ChatProtocol.ERROR_FORBIDDEN)
+            if result.action == 'tag':
+                flagged = True
+            data = result.message
+        
+        final = bool(chunk.get('final'))
+        # streams được shed_streams()/remove_client() duyệt trong self.lock
+        with self.lock:
+            if final:
+                streams.pop(stream_id, None)
+            else:
+                streams[stream_id] = seq + 1
+        
+        relay = {
+            "nickname": nickname,
+            "stream_id": stream_id,
+            "seq": seq,
+            "final": final,
+            "data": data,
+            "timestamp": time.time()
+        }
+        if seq == 0 and chunk.get('name'):
+            relay["name"] = str(chunk['name'])
+        if flagged:
+            relay["flagged"] = True
+        self.broadcast(ChatProtocol.STREAM_CHUNK, relay, client_socket, stream=(nickname, stream_id))
+        if final:
+            print(f"[STREAM] {nickname}: stream {stream_id} xong ({seq + 1} chunk)")
+    
+    def handle_search_request(self, client_socket, request):
+        """Tìm trong lịch sử chat: {"query", "nickname", "since", "until", "before", "limit"}.
+
+        Trả về SEARCH_RESPONSE {"query", "hits": [...], "next"}; gửi lại "next"
+        làm "before" để lấy trang tiếp theo (cũ hơn).
+        """
+        if client_socket not in self.clients:
+            return
+        if isinstance(request, str):
+            request = {"query": request}
+        if not isinstance(request, dict):
+            request = {}
+        
+        def field(key, types):
+            value = request.get(key)
+            return value if isinstance(value, types) and not isinstance(value, bool) else None
+        
+        query = field('query', str)
+        nickname = field('nickname', str)
+        if not (query or nickname):
+            self.send_to_client(client_socket, ChatProtocol.ERROR, {
+                "error_code": ChatProtocol.ERROR_BAD_REQUEST,
+                "error_message": "SEARCH_REQUEST cần \"query\" hoặc \"nickname\"",
+                "timestamp": time.time()
+            })
+            return
+        if self.history is None:
+            hits, next_before = [], None
+        else:
+            hits, next_before = self.history.search(
+                query, nickname, field('since', (int, float)), field('until', (int, float)),
+                field('before', int), field('limit', int) or 20)
+        response = {"query": query, "hits": hits, "next": next_before}
+        if nickname:
+            response["nickname"] = nickname
+        self.send_to_client(client_socket, ChatProtocol.SEARCH_RESPONSE, response)
+    
+    def handle_multicast_nack(self, client_socket, nack):
+        """Gửi lại qua TCP các frame multicast client bị mất.
+
+        nack: {"ranges": [[from, to], ...]}. Mỗi frame trả về 1 MCAST_REPAIR
+        {"seq", "type", "data"}; đoạn đã ra khỏi ring buffer trả về 1 frame
+        {"seq", "to", "lost": true} để client bỏ qua.
+        """
+        if self.multicast is None or client_socket not in self.clients:
+            return
+        if not isinstance(nack, dict) or not isinstance(nack.get('ranges'), list):
+            return
+        budget = self.NACK_LIMIT
+        for item in nack['ranges']:
+            try:
+                first, last = int(item[0]), int(item[1])
+            except (TypeError, ValueError, IndexError):
+                continue
+            last = min(last, first + budget - 1)
+            lost_from = None
+            for seq in range(first, last + 1):
+                frame = self.multicast.get(seq)
+                if frame is None:
+                    if lost_from is None:
+                        lost_from = seq
+                    continue
+                if lost_from is not None:
+                    self.send_to_client(client_socket, ChatProtocol.MCAST_REPAIR,
+                                        {"seq": lost_from, "to": seq - 1, "lost": True})
+                    lost_from = None
+                self.send_to_client(client_socket, ChatProtocol.MCAST_REPAIR, {
+                    "seq": seq,
+                    "type": frame[4],
+                    "data": frame[9:].decode('utf-8')
+                })
+            if lost_from is not None:
+                self.send_to_client(client_socket, ChatProtocol.MCAST_REPAIR,
+                                    {"seq": lost_from, "to": last, "lost": True})
+            budget -= last - first + 1
+            if budget <= 0:
+                break
+    
     def handle_client_message(self, client_socket, msg_type, data):
         """Xử lý các loại message từ client"""
         try:
             if msg_type == ChatProtocol.LOGIN_REQUEST:
+                if isinstance(data, dict):
+                    return self.handle_login_request(client_socket, data.get('nickname'), data)
                 return self.handle_login_request(client_socket, data)
             
             elif msg_type == ChatProtocol.CHAT_MESSAGE:
                 self.handle_chat_message(client_socket, data)
                 return True
             
+            elif msg_type == ChatProtocol.STREAM_CHUNK:
+                self.handle_stream_chunk(client_socket, data)
+                return True
+            
+            elif msg_type == ChatProtocol.MCAST_NACK:
+                self.handle_multicast_nack(client_socket, data)
+                return True
+            
+            elif msg_type == ChatProtocol.SEARCH_REQUEST:
+                self.handle_search_request(client_socket, data)
+                return True
+            
             elif msg_type == ChatProtocol.PING:
                 # Respond with PONG
                 pong_data = {"timestamp": time.time()}
@@ -253,90 +1748,866 @@ class ChatServer:
             print(f"[SERVER] Error handling message: {e}")
             return False
     
-    def handle_client(self, client_socket, address):
-        """Xử lý kết nối từ client"""
+    def process_buffer(self, client_socket, buffer):
+        """Xử lý mọi message hoàn chỉnh trong buffer.
+
+        Trả về phần buffer còn lại, hoặc None nếu client phải ngắt kết nối.
+        """
+        while len(buffer) >= 9:
+            # Try to get message length
+            try:
+                length = struct.unpack('!L', buffer[5:9])[0]
+                total_msg_len = 9 + length
+                if length > self.MAX_FRAME:
+                    # Không buffer cả payload lớn trong RAM; client phải dùng STREAM_CHUNK
+                    self.send_to_client(client_socket, ChatProtocol.ERROR, {
+                        "error_code": ChatProtocol.ERROR_BAD_REQUEST,
+                        "error_message": f"Frame {length} bytes vượt quá {self.MAX_FRAME}, hãy gửi bằng STREAM_CHUNK",
+                        "timestamp": time.time()
+                    })
+                    return None
+                
+                if len(buffer) >= total_msg_len:
+                    # Extract complete message
+                    msg_bytes = buffer[:total_msg_len]
+                    buffer = buffer[total_msg_len:]
+                    if self.capture:
+                        self.capture.record(TraceWriter.FRAME, client_socket, msg_bytes)
+                    
+                    # Process message
+                    msg_type, msg_data = ChatProtocol.unpack_message(msg_bytes)
+                    if msg_type is not None:
+                        if not self.handle_client_message(client_socket, msg_type, msg_data):
+                            return None  # Client should disconnect
+                else:
+                    break  # Wait for more data
+            except Exception as e:
+                print(f"[SERVER] Error processing buffer: {e}")
+                buffer = b''  # Clear corrupted buffer
+                break
+        return buffer
+    
+    def make_poller(self, client_socket):
+        """poll() trên socket client + pipe đánh thức (None nếu OS không có poll)"""
+        if not hasattr(select, 'poll'):
+            return None
+        poller = select.poll()
+        poller.register(client_socket, select.POLLIN)
+        poller.register(self.wake_r, select.POLLIN)
+        return poller
+    
+    def wait_readable(self, client_socket, poller):
+        """Chờ socket có dữ liệu; False nếu đang bàn giao (hot restart) => dừng đọc"""
+        if poller is None:
+            return True
+        if isinstance(client_socket, ssl.SSLSocket) and client_socket.pending():
+            return True  # Dữ liệu đã giải mã nằm sẵn trong SSL buffer
+        poller.poll()
+        return not self.handing_off
+    
+    def login_worker(self):
+        """Login worker: lấy kết nối đã có LOGIN_REQUEST từ hàng đợi admission và xử lý"""
+        while True:
+            client_socket, address, buffer = self.admission.get()
+            try:
+                self.admit_client(client_socket, address, buffer)
+            except Exception as e:
+                print(f"[SERVER] Error admitting {address}: {e}")
+    
+    def admit_client(self, client_socket, address, buffer):
+        """Xử lý LOGIN_REQUEST đã nhận đủ (xem accept_loop), rồi chuyển cho thread reader riêng.
+
+        Số login worker cố định nên login storm không sinh ra hàng nghìn thread
+        cùng lúc; worker không bao giờ chờ socket nên client im lặng hay
+        handshake chậm không giữ được worker.
+        """
         print(f"[SERVER] Xử lý kết nối từ {address}")
-        buffer = b''
+        with self.lock:
+            self.outboxes[client_socket] = Outbox(self, client_socket)
+        if self.capture:
+            self.capture.record(TraceWriter.OPEN, client_socket)
+        
+        buffer = self.process_buffer(client_socket, buffer)
+        if buffer is None or client_socket not in self.clients:
+            self.remove_client(client_socket)  # Đăng nhập thất bại (ERROR đã nằm trong Outbox)
+            return
+        
+        client_thread = threading.Thread(
+            target=self.handle_client,
+            args=(client_socket, address, buffer)
+        )
+        client_thread.daemon = True
+        client_thread.start()
+    
+    def handle_client(self, client_socket, address, buffer=b''):
+        """Đọc message từ 1 client đã có Outbox (qua admit_client hoặc hot restart).
+
+        buffer: phần dữ liệu đã nhận nhưng chưa xử lý (từ login worker hoặc process cũ).
+        """
+        with self.readers_cond:
+            self.readers += 1
+        parked = False
         
         try:
+            poller = self.make_poller(client_socket)
             while True:
+                # Buffer bàn giao từ process cũ có thể đã chứa message hoàn chỉnh
+                buffer = self.process_buffer(client_socket, buffer)
+                if buffer is None:
+                    return
+                self.track_inbound(client_socket, len(buffer))
+                
+                if self.budget is not None and not self.budget.readable.is_set():
+                    # Quá ngưỡng pause: ngừng đọc, kernel TCP đẩy ngược về phía client gửi
+                    self.budget.readable.wait(self.BUDGET_TICK)
+                    if client_socket in self.outboxes and not self.handing_off:
+                        continue
+                
+                if not self.wait_readable(client_socket, poller):
+                    # Hot restart: giữ lại buffer nhận dở để bàn giao
+                    self.handoff_buffers[client_socket] = buffer
+                    parked = True
+                    return
+                
                 # Receive data
                 data = client_socket.recv(4096)
                 if not data:
                     break
                 
                 buffer += data
-                
-                # Process all complete messages in buffer
-                while len(buffer) >= 9:
-                    # Try to get message length
-                    try:
-                        length = struct.unpack('!L', buffer[5:9])[0]
-                        total_msg_len = 9 + length
-                        
-                        if len(buffer) >= total_msg_len:
-                            # Extract complete message
-                            msg_bytes = buffer[:total_msg_len]
-                            buffer = buffer[total_msg_len:]
-                            
-                            # Process message
-                            msg_type, msg_data = ChatProtocol.unpack_message(msg_bytes)
-                            if msg_type is not None:
-                                if not self.handle_client_message(client_socket, msg_type, msg_data):
-                                    return  # Client should disconnect
-                        else:
-                            break  # Wait for more data
-                    except Exception as e:
-                        print(f"[SERVER] Error processing buffer: {e}")
-                        buffer = b''  # Clear corrupted buffer
-                        break
                         
         except Exception as e:
             print(f"[SERVER] Error in handle_client: {e}")
         finally:
+            self.track_inbound(client_socket, 0)
+            with self.readers_cond:
+                self.readers -= 1
+                self.readers_cond.notify_all()
+            if not parked:
+                self.remove_client(client_socket)
+    
+    def track_inbound(self, client_socket, size):
+        """Cập nhật bytes buffer nhận dở của client (chỉ thread reader của client gọi)"""
+        if self.budget is None:
+            return
+        previous = self.inbound_sizes.get(client_socket, 0)
+        if size == previous:
+            return
+        if size:
+            self.inbound_sizes[client_socket] = size
+        else:
+            self.inbound_sizes.pop(client_socket, None)
+        self.budget.charge('inbound', size - previous)
+    
+    def budget_loop(self):
+        """Thread áp dụng các mức phản ứng của MemoryBudget (pause do reader tự chờ)"""
+        level = MemoryBudget.NORMAL
+        paused_since = None
+        while not self.stopped.wait(self.BUDGET_TICK):
+            try:
+                level, paused_since = self.apply_budget(level, paused_since)
+            except Exception as e:
+                print(f"[SERVER] Lỗi kiểm tra ngân sách bộ nhớ: {e}")
+    
+    def apply_budget(self, level, paused_since):
+        """1 tick của budget_loop; trả về (mức, thời điểm bắt đầu pause) mới"""
+        budget = self.budget
+        current = budget.level()
+        if current != level:
+            print(f"[SERVER] Bộ nhớ {budget.total >> 20}/{budget.limit >> 20}MB: "
+                  f"mức {MemoryBudget.LEVEL_NAMES[level]} -> {MemoryBudget.LEVEL_NAMES[current]}")
+            level = current
+        if budget.readable.is_set():
+            paused_since = None
+        elif paused_since is None:
+            paused_since = time.monotonic()
+        
+        if level >= MemoryBudget.SHED:
+            self.shed_streams()
+        if level >= MemoryBudget.EVICT:
+            # Về dưới ngưỡng reject để không ngắt lại ngay ở tick sau
+            self.evict(budget.total - budget.bounds[MemoryBudget.REJECT - 1])
+        elif paused_since is not None and time.monotonic() - paused_since > self.STALL_TIMEOUT:
+            # Dữ liệu không giảm dù đã ngừng đọc (vd client nhận quá chậm)
+            if self.evict(1):
+                paused_since = time.monotonic()
+        return level, paused_since
+    
+    def shed_streams(self):
+        """Hủy mọi stream: bỏ chunk đang chờ trong Outbox và stream đang nhận dở"""
+        with self.lock:
+            open_streams = [(client_socket, user_info['nickname'], stream_id)
+                            for client_socket, user_info in self.clients.items()
+                            for stream_id in user_info.get('streams', {})]
+            open_keys = {(nickname, stream_id) for _, nickname, stream_id in open_streams}
+            for outbox in self.outboxes.values():
+                # Stream đã nhận xong nhưng chưa gửi hết => báo hủy riêng cho client này;
+                # stream còn đang nhận được báo hủy qua broadcast bên dưới
+                for key in outbox.shed_bulk():
+                    if key not in open_keys and isinstance(key, tuple):
+                        outbox.put(ChatProtocol.pack_message(ChatProtocol.STREAM_CHUNK, {
+                            "nickname": key[0], "stream_id": key[1], "final": True,
+                            "aborted": True, "timestamp": time.time()
+                        }), stream=key)
+            for client_socket, nickname, stream_id in open_streams:
+                self.clients[client_socket]['streams'].pop(stream_id, None)
+                self.broadcast(ChatProtocol.STREAM_CHUNK, {
+                    "nickname": nickname, "stream_id": stream_id, "final": True,
+                    "aborted": True, "timestamp": time.time()
+                }, client_socket, stream=(nickname, stream_id))
+                self.send_to_client(client_socket, ChatProtocol.ERROR, {
+                    "error_code": ChatProtocol.ERROR_SERVER_BUSY,
+                    "error_message": f"Server đang quá tải, stream {stream_id} bị hủy",
+                    "timestamp": time.time()
+                })
+        if open_streams:
+            self.budget.count("shed_streams", len(open_streams))
+            print(f"[SERVER] Quá tải bộ nhớ: hủy {len(open_streams)} stream")
+    
+    def consumers(self):
+        """[(bytes, client_socket)] buffer nhận + hàng đợi gửi, lớn nhất trước"""
+        with self.lock:
+            sizes = [(outbox.bytes + self.inbound_sizes.get(client_socket, 0), client_socket)
+                     for client_socket, outbox in self.outboxes.items()]
+        sizes.sort(key=lambda item: item[0], reverse=True)
+        return sizes
+    
+    def evict(self, target):
+        """Ngắt các client giữ nhiều bytes nhất tới khi giải phóng được target bytes"""
+        evicted = 0
+        for size, client_socket in self.consumers():
+            if target <= 0 or size == 0:
+                break
+            outbox = self.outboxes.get(client_socket)
+            if outbox is None:
+                continue
+            user_info = self.clients.get(client_socket)
+            name = user_info['nickname'] if user_info else 'chưa đăng nhập'
+            outbox.discard()
+            outbox.put(ChatProtocol.pack_message(ChatProtocol.ERROR, {
+                "error_code": ChatProtocol.ERROR_SERVER_BUSY,
+                "error_message": "Server đang quá tải, kết nối bị ngắt",
+                "timestamp": time.time()
+            }))
             self.remove_client(client_socket)
+            if outbox.sending:
+                # Writer kẹt trong sendall() tới client chậm => ngắt ngay
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+            target -= size
+            evicted += 1
+            print(f"[SERVER] Quá tải bộ nhớ: ngắt {name} ({size} bytes)")
+        if evicted:
+            self.budget.count("evicted", evicted)
+        return evicted
     
-    def start_server(self):
-        """Khởi động server"""
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def login_ready(self, buffer):
+        """True khi buffer đã có đủ frame LOGIN_REQUEST (hoặc dữ liệu mà worker phải từ chối)"""
+        offset = 0
+        while len(buffer) - offset >= 9:
+            length = struct.unpack_from('!L', buffer, offset + 5)[0]
+            if length > self.MAX_FRAME:
+                return True  # process_buffer trả ERROR rồi ngắt
+            if buffer[offset + 4] == ChatProtocol.LOGIN_REQUEST and len(buffer) >= offset + 9 + length:
+                return True
+            offset += 9 + length
+        return len(buffer) > self.PRELOGIN_LIMIT
+    
+    def read_prelogin(self, client_socket, pending):
+        """Tiến thêm 1 bước (non-blocking) cho kết nối chưa đăng nhập.
+
+        Trả về events cần chờ tiếp, 0 nếu đã đủ LOGIN_REQUEST, None nếu phải đóng.
+        """
+        try:
+            if pending['handshake']:
+                client_socket.do_handshake()
+                pending['handshake'] = False
+            while True:
+                data = client_socket.recv(4096)
+                if not data:
+                    return None
+                pending['buffer'] += data
+                if self.login_ready(pending['buffer']):
+                    return 0
+        except ssl.SSLWantWriteError:
+            return selectors.EVENT_WRITE
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return selectors.EVENT_READ
+        except Exception as e:
+            if pending['handshake']:
+                print(f"[SERVER] TLS handshake thất bại với {pending['address']}: {e}")
+            return None
+    
+    def accept_loop(self):
+        """Vòng accept + tiền đăng nhập; dừng khi self.accepting = False (shutdown/bàn giao).
+
+        1 thread với selector: accept liên tục tới EAGAIN, rồi làm TLS handshake
+        và đọc tới khi có đủ LOGIN_REQUEST ở chế độ non-blocking; chỉ kết nối đã
+        sẵn sàng mới vào hàng đợi admission. Kết nối im lặng chỉ tốn 1 fd và bị
+        đóng sau LOGIN_TIMEOUT. Khi hàng đợi admission đầy thì ngừng accept
+        (kết nối mới nằm lại trong kernel backlog) tới khi login worker rảnh.
+        """
+        server = self.listen_socket
+        server.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        listening = True
+        ready = deque()  # [(socket, address, buffer)] chờ chỗ trong hàng đợi admission
+        next_expiry = time.monotonic() + 1.0
+        self.accepting = True
+        self.accept_done.clear()
+        
+        while self.accepting:
+            for key, _ in selector.select(timeout=0.05 if ready else 0.5):
+                if key.fileobj is server:
+                    while self.accepting:
+                        try:
+                            client_socket, address = server.accept()
+                        except BlockingIOError:
+                            break  # Đã accept hết các kết nối đang chờ
+                        except Exception as e:
+                            if self.accepting:
+                                print(f"[SERVER] Error accepting connection: {e}")
+                            break
+                        client_socket.setblocking(False)
+                        if self.ssl_context is not None:
+                            client_socket = self.ssl_context.wrap_socket(
+                                client_socket, server_side=True, do_handshake_on_connect=False)
+                        selector.register(client_socket, selectors.EVENT_READ, {
+                            "address": address,
+                            "buffer": b'',
+                            "handshake": self.ssl_context is not None,
+                            "deadline": time.monotonic() + self.LOGIN_TIMEOUT
+                        })
+                    continue
+                
+                client_socket, pending = key.fileobj, key.data
+                events = self.read_prelogin(client_socket, pending)
+                if events:
+                    if events != key.events:
+                        selector.modify(client_socket, events, pending)
+                    continue
+                selector.unregister(client_socket)
+                if events is None:
+                    client_socket.close()
+                else:
+                    client_socket.setblocking(True)
+                    ready.append((client_socket, pending['address'], pending['buffer']))
+            
+            # Giao kết nối đã sẵn sàng cho worker; hàng đợi đầy => tạm ngừng accept
+            while ready:
+                try:
+                    self.admission.put_nowait(ready[0])
+                except queue.Full:
+                    break
+                ready.popleft()
+            if ready and listening:
+                selector.unregister(server)
+                listening = False
+            elif not ready and not listening:
+                selector.register(server, selectors.EVENT_READ)
+                listening = True
+            
+            self.prelogin = len(selector.get_map()) - listening
+            now = time.monotonic()
+            if now >= next_expiry:
+                next_expiry = now + 1.0
+                expired = [key for key in selector.get_map().values()
+                           if key.data is not None and key.data['deadline'] < now]
+                for key in expired:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                if expired:
+                    print(f"[SERVER] Đóng {len(expired)} kết nối không đăng nhập trong {self.LOGIN_TIMEOUT}s")
         
+        # Kết nối chưa đăng nhập không được bàn giao/flush: client sẽ kết nối lại
+        for key in list(selector.get_map().values()):
+            if key.fileobj is not server:
+                key.fileobj.close()
+        for client_socket, _, _ in ready:
+            client_socket.close()
+        self.prelogin = 0
+        selector.close()
+        self.accept_done.set()
+    
+    def start_server(self):
+        """Khởi động server; trả về khi server đã shutdown hoặc bàn giao xong"""
         try:
-            server.bind((self.host, self.port))
-            server.listen(10)
+            if self.listen_socket is None:
+                server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                server.bind((self.host, self.port))
+                server.listen(self.backlog)
+                self.listen_socket = server
             
             print(f"[SERVER] Chat server đang chạy tại {self.host}:{self.port}")
             print(f"[SERVER] Protocol version: {ChatProtocol.VERSION}")
+            if self.ssl_context is not None:
+                ktls = bool(self.ssl_context.options & getattr(ssl, 'OP_ENABLE_KTLS', 0))
+                print(f"[SERVER] TLS bật (kTLS: {'có' if ktls else 'không hỗ trợ'})")
+            if self.multicast is not None:
+                print(f"[SERVER] Multicast fan-out tới {self.multicast.group}:{self.multicast.port}")
+            if self.budget is not None:
+                print(f"[SERVER] Ngân sách bộ nhớ: {self.budget.limit >> 20}MB")
             print("[SERVER] Đang chờ kết nối...")
             
-            while True:
-                try:
-                    client_socket, address = server.accept()
-                    
-                    # Tạo thread để xử lý client
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_socket, address)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except Exception as e:
-                    print(f"[SERVER] Error accepting connection: {e}")
+            for _ in range(self.login_workers):
+                worker = threading.Thread(target=self.login_worker)
+                worker.daemon = True
+                worker.start()
+            presence_thread = threading.Thread(target=self.presence_loop)
+            presence_thread.daemon = True
+            presence_thread.start()
+            if self.budget is not None:
+                budget_thread = threading.Thread(target=self.budget_loop, name='memory_budget')
+                budget_thread.daemon = True
+                budget_thread.start()
+            
+            self.accept_loop()
+            self.stopped.wait()
                     
         except Exception as e:
             print(f"[SERVER] Error starting server: {e}")
-        finally:
-            server.close()
+    
+    def shutdown(self, drain_timeout=5.0, reconnect_window=10.0):
+        """Tắt server nhẹ nhàng.
+
+        Ngừng accept, gửi SERVER_SHUTDOWN sau các frame đang chờ của mỗi client,
+        chờ hàng đợi gửi flush (tối đa drain_timeout) rồi mới đóng kết nối.
+        reconnect_after được rải ngẫu nhiên trong reconnect_window giây để các
+        client không cùng reconnect một lúc.
+        """
+        print("[SERVER] Đang tắt: ngừng nhận kết nối mới, flush hàng đợi gửi...")
+        self.accepting = False
+        self.shutting_down = True
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+        
+        with self.lock:
+            connections = list(self.outboxes.items())
+        
+        for client_socket, outbox in connections:
+            notice = {
+                "message": "Server đang khởi động lại, vui lòng kết nối lại",
+                "reconnect_after": round(random.uniform(1.0, reconnect_window), 2),
+                "timestamp": time.time()
+            }
+            outbox.put(ChatProtocol.pack_message(ChatProtocol.SERVER_SHUTDOWN, notice))
+        
+        deadline = time.time() + drain_timeout
+        for client_socket, outbox in connections:
+            outbox.flush(max(0.0, deadline - time.time()))
+            self.remove_client(client_socket)
+        
+        print(f"[SERVER] Đã đóng {len(connections)} kết nối")
+        if self.capture:
+            self.capture.close()
+        self.stopped.set()
+    
+    def serve_handoff(self, path):
+        """Chờ process mới xin bàn giao socket (hot restart) qua Unix socket path"""
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        listener.bind(path)
+        listener.listen(1)
+        
+        def handoff_loop():
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    break
+                with conn:
+                    if conn.recv(64) == b'TAKEOVER' and self.hand_off(conn):
+                        break
+            listener.close()
+            if self.stopped.is_set() and os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        
+        thread = threading.Thread(target=handoff_loop)
+        thread.daemon = True
+        thread.start()
+        print(f"[SERVER] Chờ yêu cầu hot restart tại {path}")
+    
+    def serve_control(self, path):
+        """Control socket cho admin (Unix socket, quyền 0600 => chỉ user chạy server).
+
+        Mỗi kết nối gửi 1 dòng lệnh, server trả kết quả dạng text rồi đóng:
+            profile [giây] [interval_ms]   lấy mẫu stack, trả về collapsed stacks
+            timing on|off|reset|dump       histogram thời gian các handler
+            filter reload|stats            nạp lại / thống kê bộ lọc nội dung
+            stats                          số kết nối, hàng đợi, ...
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(8)
+        
+        def control_loop():
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    break
+                thread = threading.Thread(target=self.handle_control, args=(conn,))
+                thread.daemon = True
+                thread.start()
+            listener.close()
+        
+        thread = threading.Thread(target=control_loop, name='control')
+        thread.daemon = True
+        thread.start()
+        print(f"[SERVER] Control socket tại {path}")
+    
+    def handle_control(self, conn):
+        """Đọc 1 dòng lệnh từ control socket và gửi lại kết quả"""
+        with conn:
+            try:
+                conn.settimeout(5)
+                line = b''
+                while b'\n' not in line and len(line) < 1024:
+                    chunk = conn.recv(1024)
+                    if not chunk:
+                        break
+                    line += chunk
+                conn.settimeout(None)
+                try:
+                    reply = self.control_command(line.decode('utf-8', 'replace').split())
+                except Exception as e:
+                    # Tham số sai (vd "memory abc") => trả lỗi thay vì đóng kết nối im lặng
+                    reply = f"ERROR tham số không hợp lệ: {e}"
+                conn.sendall((reply + '\n').encode('utf-8'))
+            except Exception as e:
+                print(f"[SERVER] Lỗi control socket: {e}")
+    
+    def control_command(self, args):
+        command = args[0] if args else ''
+        if command == 'profile':
+            try:
+                duration = float(args[1]) if len(args) > 1 else 10.0
+                interval = float(args[2]) / 1000 if len(args) > 2 else 0.005
+            except ValueError:
+                return "ERROR profile [giây] [ms mỗi mẫu]"
+            if not 0 < duration <= self.MAX_PROFILE:
+                return f"ERROR thời gian profile phải trong (0, {self.MAX_PROFILE}] giây"
+            if interval < self.MIN_PROFILE_INTERVAL:
+                return f"ERROR chu kỳ lấy mẫu tối thiểu {self.MIN_PROFILE_INTERVAL * 1000:g}ms"
+            if not self.profile_lock.acquire(blocking=False):
+                return "ERROR profiler đang chạy"
+            try:
+                print(f"[SERVER] Profile {duration}s (mỗi {interval * 1000:.1f}ms)")
+                return SamplingProfiler(interval).run(duration).collapsed()
+            finally:
+                self.profile_lock.release()
+        
+        elif command == 'timing':
+            action = args[1] if len(args) > 1 else 'dump'
+            if action == 'on':
+                self.timer.enable()
+            elif action == 'off':
+                self.timer.disable()
+            elif action == 'reset':
+                self.timer.reset()
+            elif action != 'dump':
+                return "ERROR timing on|off|reset|dump"
+            if action == 'dump':
+                return self.timer.dump()
+            return f"OK timing {'on' if self.timer.enabled else 'off'}"
+        
+        elif command == 'filter':
+            action = args[1] if len(args) > 1 else 'stats'
+            filters = [f for f in self.inbound_filters if isinstance(f, ContentFilter)]
+            if not filters:
+                return "ERROR chưa bật bộ lọc (--filter-terms)"
+            if action == 'reload':
+                return f"OK {sum(f.reload() for f in filters)} term"
+            return json.dumps([dict(f.stats, nodes=f.automaton.size) for f in filters])
+        
+        elif command == 'memory':
+            if self.budget is None:
+                return "ERROR chưa bật ngân sách bộ nhớ (--memory-budget)"
+            top = int(args[1]) if len(args) > 1 else 10
+            consumers = []
+            for size, client_socket in self.consumers()[:top]:
+                user_info = self.clients.get(client_socket)
+                outbox = self.outboxes.get(client_socket)
+                consumers.append({
+                    "nickname": user_info['nickname'] if user_info else None,
+                    "bytes": size,
+                    "inbound": self.inbound_sizes.get(client_socket, 0),
+                    "outbox_frames": len(outbox) if outbox is not None else 0
+                })
+            return json.dumps(dict(self.budget.snapshot(), top=consumers), indent=2)
+        
+        elif command == 'stats':
+            with self.lock:
+                stats = {
+                    "uptime": round(time.time() - self.started_at, 1),
+                    "clients": len(self.clients),
+                    "connections": len(self.outboxes),
+                    "outbox_frames": sum(len(outbox) for outbox in self.outboxes.values()),
+                    "sessions": len(self.sessions),
+                    "history": self.history.stats() if self.history is not None else None,
+                    "memory": self.budget.snapshot() if self.budget is not None else None,
+                    "admission_queue": self.admission.qsize(),
+                    "prelogin": self.prelogin,
+                    "threads": threading.active_count(),
+                    "timing": self.timer.enabled
+                }
+            return json.dumps(stats, indent=2)
+        
+        return ("ERROR lệnh: profile [giây] [interval_ms] | timing on|off|reset|dump | filter reload|stats"
+                " | memory [top] | stats")
+    
+    def hand_off(self, conn, timeout=5.0):
+        """Bàn giao listening socket + kết nối client cho process mới (SCM_RIGHTS).
+
+        Client TLS không bàn giao được (trạng thái SSL nằm trong process này) nên
+        nhận SERVER_SHUTDOWN như khi tắt server. Trả về True nếu bàn giao xong.
+        """
+        print("[SERVER] Bắt đầu hot restart: bàn giao socket cho process mới")
+        self.accepting = False
+        self.accept_done.wait(timeout)
+        
+        # Đánh thức mọi reader để chúng dừng đọc và giữ lại buffer nhận dở
+        self.handing_off = True
+        os.write(self.wake_w, b'x')
+        with self.readers_cond:
+            self.readers_cond.wait_for(lambda: self.readers == 0, timeout)
+        
+        with self.lock:
+            connections = list(self.outboxes.items())
+        entries = []
+        drained = {}  # {client_socket: bytes chưa gửi} để gửi tiếp nếu bàn giao thất bại
+        for client_socket, outbox in connections:
+            if isinstance(client_socket, ssl.SSLSocket) or client_socket not in self.handoff_buffers:
+                continue
+            pending = outbox.detach(timeout)
+            if pending is None:
+                continue
+            drained[client_socket] = pending
+            user_info = self.clients.get(client_socket)
+            window = user_info.get('dedup') if user_info else None
+            entries.append((client_socket, {
+                "nickname": user_info['nickname'] if user_info else None,
+                "joined_at": user_info['joined_at'] if user_info else None,
+                "session": user_info.get('session') if user_info else None,
+                "dedup": list(window.order) if window else [],
+                "streams": user_info.get('streams', {}) if user_info else {},
+                "multicast": bool(user_info and user_info.get('multicast')),
+                "presence": user_info.get('presence', 'legacy') if user_info else 'legacy',
+                "address": list(client_socket.getpeername()),
+                "buffer": base64.b64encode(self.handoff_buffers[client_socket]).decode('ascii'),
+                "outbound": base64.b64encode(pending).decode('ascii')
+            }))
+        
+        try:
+            header = {"type": "listen", "host": self.host, "port": self.port}
+            if self.multicast is not None:
+                header["multicast"] = {"epoch": self.multicast.epoch, "seq": self.multicast.seq}
+            with self.presence_cond:
+                # Thời gian grace còn lại của những người đang chờ báo rời đi
+                now = time.monotonic()
+                header["pending_leaves"] = {nickname: deadline - now
+                                            for nickname, deadline in self.pending_leaves.items()}
+            socket.send_fds(conn, [json.dumps(header).encode('utf-8')], [self.listen_socket.fileno()])
+            for start in range(0, len(entries), self.HANDOFF_BATCH):
+                batch = entries[start:start + self.HANDOFF_BATCH]
+                message = {"type": "clients", "clients": [info for _, info in batch]}
+                socket.send_fds(conn, [json.dumps(message).encode('utf-8')],
+                                [client_socket.fileno() for client_socket, _ in batch])
+            conn.send(json.dumps({"type": "end"}).encode('utf-8'))
+            conn.settimeout(timeout * 2)
+            if conn.recv(64) != b'DONE':
+                raise ConnectionError("process mới không xác nhận")
+        except Exception as e:
+            print(f"[SERVER] Hot restart thất bại, tiếp tục phục vụ: {e}")
+            self.resume_after_failed_handoff(drained)
+            return False
+        
+        # Process mới đã giữ bản sao fd: chỉ close() ở đây, không shutdown()
+        handed = {client_socket for client_socket, _ in entries}
+        self.shutting_down = True
+        for client_socket, outbox in connections:
+            if client_socket not in handed:
+                outbox.put(ChatProtocol.pack_message(ChatProtocol.SERVER_SHUTDOWN, {
+                    "message": "Server đang khởi động lại, vui lòng kết nối lại",
+                    "reconnect_after": round(random.uniform(1.0, 10.0), 2),
+                    "timestamp": time.time()
+                }))
+                outbox.flush(timeout)
+                self.remove_client(client_socket)
+            else:
+                client_socket.close()
+        self.listen_socket.close()
+        print(f"[SERVER] Đã bàn giao {len(entries)}/{len(connections)} kết nối cho process mới")
+        if self.capture:
+            self.capture.close()
+        self.stopped.set()
+        return True
+    
+    def resume_after_failed_handoff(self, drained):
+        """Khởi động lại reader/writer và vòng accept sau khi bàn giao thất bại.
+
+        drained: bytes hand_off() đã lấy ra khỏi các Outbox, được xếp lại vào
+        Outbox mới trước mọi frame mới.
+        """
+        os.read(self.wake_r, 1)
+        self.handing_off = False
+        parked, self.handoff_buffers = self.handoff_buffers, {}
+        with self.lock:
+            for client_socket in list(self.outboxes):
+                outbox = self.outboxes[client_socket]
+                if outbox.detached:
+                    pending = drained[client_socket] if client_socket in drained else outbox.detach(0)
+                    self.outboxes[client_socket] = Outbox(self, client_socket)
+                    if pending:
+                        self.outboxes[client_socket].put(pending, Outbox.CONTROL)  # Gửi trước frame mới
+        for client_socket, buffer in parked.items():
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, client_socket.getpeername(), buffer)
+            )
+            client_thread.daemon = True
+            client_thread.start()
+        accept_thread = threading.Thread(target=self.accept_loop)
+        accept_thread.daemon = True
+        accept_thread.start()
+    
+    def take_over(self, path):
+        """Nhận listening socket + kết nối client từ process cũ (hot restart)"""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        conn.connect(path)
+        conn.send(b'TAKEOVER')
+        
+        handed_off = []
+        with conn:
+            while True:
+                message, fds, _, _ = socket.recv_fds(conn, 1 << 20, self.HANDOFF_BATCH + 1)
+                header = json.loads(message.decode('utf-8'))
+                if header['type'] == 'listen':
+                    self.listen_socket = socket.socket(fileno=fds[0])
+                    self.host, self.port = header['host'], header['port']
+                    if self.multicast is not None and header.get('multicast'):
+                        # Giữ epoch/seq để client multicast không phải đồng bộ lại
+                        self.multicast.resume(header['multicast']['epoch'], header['multicast']['seq'])
+                    now = time.monotonic()
+                    with self.presence_cond:
+                        for nickname, remaining in header.get('pending_leaves', {}).items():
+                            self.pending_leaves[nickname] = now + remaining
+                            self.present.add(nickname)
+                elif header['type'] == 'clients':
+                    for info, fd in zip(header['clients'], fds):
+                        handed_off.append((socket.socket(fileno=fd), info))
+                else:
+                    break
+            
+            with self.lock:
+                for client_socket, info in handed_off:
+                    outbox = Outbox(self, client_socket)
+                    self.outboxes[client_socket] = outbox
+                    if self.capture:
+                        self.capture.record(TraceWriter.OPEN, client_socket)
+                    outbound = base64.b64decode(info['outbound'])
+                    if outbound:
+                        outbox.put(outbound, Outbox.CONTROL)  # Gửi trước frame mới
+                    if info['nickname'] is not None:
+                        self.clients[client_socket] = {
+                            "nickname": info['nickname'],
+                            "joined_at": info['joined_at'],
+                            "address": tuple(info['address']),
+                            "streams": info.get('streams', {}),
+                            "multicast": info.get('multicast', False) and self.multicast is not None,
+                            "presence": info.get('presence', 'legacy')
+                        }
+                        self.nicknames.add(info['nickname'])
+                        with self.presence_cond:
+                            self.present.add(info['nickname'])
+                        if info.get('session'):
+                            window = self.session_window(info['session'])
+                            for msg_id in info['dedup']:
+                                window.add(msg_id)
+                            self.clients[client_socket]['session'] = info['session']
+                            self.clients[client_socket]['dedup'] = window
+            
+            for client_socket, info in handed_off:
+                client_thread = threading.Thread(
+                    target=self.handle_client,
+                    args=(client_socket, tuple(info['address']),
+                          base64.b64decode(info['buffer']))
+                )
+                client_thread.daemon = True
+                client_thread.start()
+            conn.send(b'DONE')
+        
+        print(f"[SERVER] Đã nhận {len(handed_off)} kết nối từ process cũ")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server (Improved Protocol)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--tls-cert', help="File certificate (PEM) để bật TLS")
+    parser.add_argument('--tls-key', help="File private key (PEM), bỏ trống nếu nằm chung file cert")
+    parser.add_argument('--handoff-socket', help="Unix socket chờ process mới xin bàn giao (hot restart)")
+    parser.add_argument('--takeover', help="Unix socket của process cũ để nhận bàn giao khi khởi động")
+    parser.add_argument('--drain-timeout', type=float, default=5.0, help="Giây chờ flush khi tắt")
+    parser.add_argument('--backlog', type=int, default=1024, help="Backlog của listen() (bị giới hạn bởi net.core.somaxconn)")
+    parser.add_argument('--login-workers', type=int, default=16, help="Số thread xử lý đăng nhập")
+    parser.add_argument('--capture', help="Ghi trace các frame nhận được vào file (để replay.py phát lại)")
+    parser.add_argument('--control-socket', help="Unix socket nhận lệnh admin (profile, timing, stats)")
+    parser.add_argument('--multicast', metavar='GROUP:PORT', help="Broadcast qua UDP multicast, vd 239.255.42.99:5007")
+    parser.add_argument('--multicast-if', default='0.0.0.0', help="IP của interface gửi multicast (127.0.0.1 để test loopback)")
+    parser.add_argument('--multicast-ttl', type=int, default=1, help="TTL multicast (1 = chỉ trong LAN)")
+    parser.add_argument('--memory-budget', type=int, default=512, metavar='MB',
+                        help="Ngân sách bộ nhớ cho buffer, hàng đợi gửi và lịch sử (0 = không giới hạn)")
+    parser.add_argument('--history', type=int, default=100000,
+                        help="Số tin chat gần nhất giữ lại để tìm kiếm (0 = tắt)")
+    parser.add_argument('--filter-terms', help="File danh sách term bị lọc (tự nạp lại khi file thay đổi)")
+    parser.add_argument('--filter-action', choices=ContentFilter.ACTIONS, default='mask',
+                        help="Action mặc định cho term không ghi action riêng")
+    args = parser.parse_args()
+    
     # Tạo và khởi động server
+    ssl_context = None
+    if args.tls_cert:
+        ssl_context = create_server_ssl_context(args.tls_cert, args.tls_key)
+    multicast = None
+    if args.multicast:
+        group, _, multicast_port = args.multicast.rpartition(':')
+        multicast = MulticastPublisher(group, int(multicast_port), args.multicast_if, args.multicast_ttl)
     chat_server = ChatServer(
-        host = '0.0.0.0'
+        host = args.host,
+        port = args.port,
+        ssl_context = ssl_context,
+        backlog = args.backlog,
+        login_workers = args.login_workers,
+        capture_path = args.capture,
+        multicast = multicast,
+        history_limit = args.history,
+        memory_budget = args.memory_budget << 20
     )
+    if args.filter_terms:
+        chat_server.add_filter(ContentFilter(args.filter_terms, args.filter_action))
+    # SIGTERM (deploy/systemd) cũng tắt nhẹ nhàng như Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
+        if args.takeover:
+            chat_server.take_over(args.takeover)
+        if args.handoff_socket:
+            chat_server.serve_handoff(args.handoff_socket)
+        if args.control_socket:
+            chat_server.serve_control(args.control_socket)
         chat_server.start_server()
     except KeyboardInterrupt:
         print("\n[SERVER] Server đang tắt...")
+        chat_server.shutdown(args.drain_timeout)
     except Exception as e:
-        print(f"[SERVER] Lỗi: {e}")
\ No newline at end of file
+        print(f"[SERVER] Lỗi: {e}")